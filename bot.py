@@ -1,72 +1,107 @@
 import time
+import asyncio
+import orjson
 import logging
+import redis.asyncio as redis
 
-from collections import OrderedDict
-from typing import Any, Optional, Dict #, Tuple, List
+from dataclasses import dataclass
+from typing import Any, Awaitable, Optional, Dict #, Tuple, List
+from telegram.ext import BaseUpdateProcessor
 
 
 logger = logging.getLogger("bot")
 
 
-class LRUCache:
-    """Простая реализация LRU кэша с TTL"""
-
-    def __init__(self, max_size: int = 1000, ttl: int = 3600):
-        self.max_size = max_size
-        self.ttl = ttl
-        self.cache = OrderedDict()
-
-    def get(self, key: str) -> Optional[Any]:
-        if key not in self.cache:
-            return None
-
-        value, timestamp = self.cache[key]
-        if time.time() - timestamp > self.ttl:
-            del self.cache[key]
-            return None
-
-        # Перемещаем в конец (самый свежий)
-        self.cache.move_to_end(key)
-        return value
-
-    def set(self, key: str, value: Any):
-        if key in self.cache:
-            # Если ключ уже есть, перемещаем в конец
-            self.cache.move_to_end(key)
-        else:
-            # Если достигли максимума, удаляем самый старый
-            if len(self.cache) >= self.max_size:
-                self.cache.popitem(last=False)
-
-        self.cache[key] = (value, time.time())
-
-    def clear_expired(self):
-        """Очистка просроченных записей"""
-        current_time = time.time()
-        keys_to_remove = []
-
-        for key, (value, timestamp) in self.cache.items():
-            if current_time - timestamp > self.ttl:
-                keys_to_remove.append(key)
-
-        for key in keys_to_remove:
-            del self.cache[key]
-
-        if keys_to_remove:
-            logger.debug(f"Cleared {len(keys_to_remove)} expired cache entries")
-
-    def clear(self):
-        """Полная очистка кэша"""
-        self.cache.clear()
-        logger.info("Cache cleared completely")
-
-    def size(self) -> int:
-        return len(self.cache)
-
-    def stats(self) -> Dict[str, Any]:
-        return {
-            "size": self.size(),
-            "max_size": self.max_size,
-            "ttl": self.ttl,
-            "keys": list(self.cache.keys())[:10]  # Первые 10 ключей для отладки
-        }
\ No newline at end of file
+@dataclass(slots=True, frozen=True)
+class HistoryEntry:
+    """Запись истории пользователя (slots - без __dict__ и повторяющихся ключей на каждую запись)"""
+    ts: float
+    story: str
+    analysis: Optional[str] = None
+
+
+class RedisStorage:
+    """Хранение истории пользователей (LIST на пользователя, обрезка через LTRIM) и кэша анализов в Redis"""
+
+    # ZSET: пользователь -> время последней активности; старше history_ttl - вычищаются
+    ACTIVE_USERS_KEY = "hist:active"
+
+    def __init__(self, url: str, max_history_depth: int = 50, history_ttl: int = 86400):
+        self.redis = redis.Redis.from_url(url)
+        self.max_history_depth = max_history_depth
+        self.history_ttl = history_ttl
+
+    async def add_to_user_history(self, user_id: int, entry: HistoryEntry) -> bool:
+        """Добавить запись в историю, возвращает True для нового пользователя"""
+        key = f"hist:{user_id}"
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, orjson.dumps(entry))
+            pipe.ltrim(key, -self.max_history_depth, -1)
+            pipe.expire(key, self.history_ttl)
+            # Активность живет столько же, сколько история: неактивных удаляем по возрасту
+            pipe.zremrangebyscore(self.ACTIVE_USERS_KEY, "-inf", now - self.history_ttl)
+            pipe.zadd(self.ACTIVE_USERS_KEY, {user_id: now})
+            results = await pipe.execute()
+        return bool(results[-1])
+
+    async def get_analysis(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.redis.get(key)
+        return orjson.loads(raw) if raw else None
+
+    async def set_analysis(self, key: str, analysis_data: Dict[str, Any], ttl: int = 86400):
+        await self.redis.setex(key, ttl, orjson.dumps(analysis_data))
+
+    async def count_users(self) -> int:
+        """Пользователи, активные за последние history_ttl секунд"""
+        return await self.redis.zcount(self.ACTIVE_USERS_KEY, time.time() - self.history_ttl, "+inf")
+
+    async def close(self):
+        await self.redis.aclose()
+        logger.info("Redis connection closed")
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных чатов с сохранением порядка внутри чата.
+
+    Долгий анализ через LLM в одном чате не задерживает ответы в других, а апдейты
+    одного чата (и его user_data) обрабатываются строго по очереди.
+    """
+
+    # Семафор библиотеки берется до do_process_update, то есть до очереди чата,
+    # поэтому его делаем заведомо большим, а реальный лимит держим сами
+    _LIBRARY_MAX_UPDATES = 4096
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(self._LIBRARY_MAX_UPDATES)
+        self._update_slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_pending: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Сначала очередь своего чата, и только потом общий лимит: апдейты, ждущие
+        # свой чат, не занимают слоты MAX_CONCURRENT_UPDATES и не задерживают другие чаты
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self._update_slots:
+                await coroutine
+            return
+
+        chat_id = chat.id
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+        try:
+            async with lock, self._update_slots:
+                await coroutine
+        finally:
+            # Блокировку чата удаляем, когда в нем не осталось ожидающих апдейтов
+            self._chat_pending[chat_id] -= 1
+            if not self._chat_pending[chat_id]:
+                del self._chat_pending[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
\ No newline at end of file
@@ -1,18 +1,63 @@
-import difflib
+import asyncio
+import bisect
+import heapq
+import time
 import logging
 import asyncpg
-import re
+import string
 
+from rapidfuzz import fuzz, process
+
+from collections import Counter
 from typing import List, Tuple, Optional, Dict
 from functools import lru_cache
 
 
 logger = logging.getLogger("database")
 
+# Таблица удаления пунктуации (включая типографские кавычки) строится один раз при импорте
+_PUNCT_TABLE = str.maketrans('', '', string.punctuation + '«»„“‚‘‛"')
+
+
+@lru_cache(maxsize=4096)
+def _word_set(normalized_text: str) -> frozenset:
+    """Множество слов нормализованного текста; для строк корпуса строится один раз"""
+    return frozenset(normalized_text.split())
+
 class ExamplesDB:
+    # Сколько кандидатов отбирает триграммный индекс для точного сравнения в Python
+    TRGM_CANDIDATES = 100
+    # Сколько секунд кэш корпуса считается свежим (записи из других процессов)
+    CORPUS_TTL = 60
+    # Сколько результатов find_similar хранится в памяти (живут CORPUS_TTL секунд)
+    SIMILAR_CACHE_SIZE = 512
+    # Через сколько секунд накопленные счетчики использования пишутся в БД
+    USAGE_FLUSH_DELAY = 1.0
+    # Сколько секунд переиспользуется результат health_check
+    HEALTH_CHECK_TTL = 15
+
     def __init__(self):
         self._pool: Optional[asyncpg.Pool] = None
+        # Первые одновременные вызовы get_pool не должны создать несколько пулов
+        self._pool_lock = asyncio.Lock()
         self._connection_string = self._get_connection_string()
+        self._trgm_available = False
+        # Кэш корпуса для поиска без pg_trgm: строки БД и параллельный список norm
+        self._corpus: Optional[Tuple[List, List[str]]] = None
+        self._corpus_loaded_at = 0.0
+        # Результаты find_similar: (normalized_query, threshold, limit) -> (результат, время).
+        # Результат хранится кортежем, вызывающим отдается копия-список
+        self._similar_cache: Dict[Tuple, Tuple[Tuple, float]] = {}
+        # Номер версии данных (растет после каждой записи в user_stories): поиск, начатый
+        # до записи, не кладет в кэш устаревший результат; по нему же сбрасываются курсоры страниц
+        self.stories_version = 0
+        # Счетчики использования, еще не записанные в БД
+        self._usage_buffer: Counter = Counter()
+        self._usage_flush_task: Optional[asyncio.Task] = None
+        # Сигнал отложенной записи "не ждать таймер" (при закрытии)
+        self._usage_flush_now = asyncio.Event()
+        # Кэш результата health_check: (время проверки, результат); -inf - проверки еще не было
+        self._health_cache = (float('-inf'), False)
         
     def _get_connection_string(self):
         """Получить строку подключения из конфигурации"""
@@ -20,22 +65,27 @@ class ExamplesDB:
         return Config.DATABASE_URL
 
     async def get_pool(self) -> asyncpg.Pool:
-        if self._pool is None:
-            try:
-                self._pool = await asyncpg.create_pool(
-                    self._connection_string,
-                    min_size=5,
-                    max_size=20,
-                    command_timeout=60,
-                    server_settings={
-                        'search_path': 'public',
-                        'application_name': 'invest_bot'
-                    }
-                )
-                logger.info("PostgreSQL connection pool created successfully")
-            except Exception as e:
-                logger.error(f"Failed to create connection pool: {e}")
-                raise
+        if self._pool is not None:
+            return self._pool
+        async with self._pool_lock:
+            if self._pool is None:
+                try:
+                    self._pool = await asyncpg.create_pool(
+                        self._connection_string,
+                        min_size=5,
+                        max_size=20,
+                        command_timeout=60,
+                        server_settings={
+                            'search_path': 'public',
+                            'application_name': 'invest_bot',
+                            # Короткие OLTP-запросы: компиляция JIT дороже самого выполнения
+                            'jit': 'off'
+                        }
+                    )
+                    logger.info("PostgreSQL connection pool created successfully")
+                except Exception as e:
+                    logger.error(f"Failed to create connection pool: {e}")
+                    raise
         return self._pool
 
     async def create_table(self) -> None:
@@ -46,6 +96,7 @@ class ExamplesDB:
                 # Включаем расширение для триграммного поиска (если нужно)
                 try:
                     await conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                    self._trgm_available = True
                 except Exception:
                     logger.warning("pg_trgm extension not available, using basic search")
                 
@@ -68,14 +119,25 @@ class ExamplesDB:
                     CREATE INDEX IF NOT EXISTS idx_normalized_query 
                     ON user_stories(normalized_query)
                 ''')
+                # Порядок корпуса (is_golden DESC, score DESC) читается одним составным индексом;
+                # отдельные индексы по булеву is_golden и по score планировщик почти не выбирал
+                await conn.execute('DROP INDEX IF EXISTS idx_is_golden')
+                await conn.execute('DROP INDEX IF EXISTS idx_score')
                 await conn.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_is_golden 
-                    ON user_stories(is_golden)
+                    CREATE INDEX IF NOT EXISTS idx_golden_score
+                    ON user_stories(is_golden DESC, score DESC)
                 ''')
+                # Порядок вывода базы: keyset-пагинация читает страницу прямо из индекса
                 await conn.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_score 
-                    ON user_stories(score)
+                    CREATE INDEX IF NOT EXISTS idx_created_score_id
+                    ON user_stories(created_at DESC, score DESC, id DESC)
                 ''')
+                if self._trgm_available:
+                    # Триграммный индекс: предварительный отбор похожих историй на стороне БД
+                    await conn.execute('''
+                        CREATE INDEX IF NOT EXISTS idx_normalized_query_trgm
+                        ON user_stories USING gin (normalized_query gin_trgm_ops)
+                    ''')
                 
             logger.info("PostgreSQL tables created with indexes")
         except Exception as e:
@@ -84,70 +146,112 @@ class ExamplesDB:
 
     async def find_similar(self, query: str, threshold: float = 0.65, limit: int = 5) -> List[Tuple]:
         """Улучшенный поиск похожих историй с семантическим сравнением"""
+        return (await self.find_similar_multi(query, (threshold,), limit))[0]
+
+    async def find_similar_multi(self, query: str, thresholds: Tuple[float, ...],
+                                 limit: int = 5) -> List[List[Tuple]]:
+        """Поиск похожих историй сразу для нескольких порогов.
+
+        Кандидаты читаются из БД один раз, но каждый порог ранжируется отдельно -
+        результат тот же, что у отдельных вызовов find_similar с этими порогами.
+        """
         normalized_query = self._normalize_query(query)
-        logger.info(f"Searching for similar to: '{normalized_query}' with threshold {threshold}")
+        results: Dict[float, List[Tuple]] = {}
+        now = time.monotonic()
+        for threshold in thresholds:
+            cache_key = (normalized_query, threshold, limit)
+            cached = self._similar_cache.pop(cache_key, None)
+            if cached is not None and now - cached[1] <= self.CORPUS_TTL:
+                # Возвращаем в конец - самый свежий
+                self._similar_cache[cache_key] = cached
+                results[threshold] = list(cached[0])
+
+        missing = [threshold for threshold in thresholds if threshold not in results]
+        if missing:
+            results.update(await self._search_similar(normalized_query, missing, limit))
+        return [results[threshold] for threshold in thresholds]
+
+    async def _search_similar(self, normalized_query: str, thresholds: List[float],
+                              limit: int) -> Dict[float, List[Tuple]]:
+        """Поиск в БД и ранжирование кандидатов для каждого порога"""
+        generation = self.stories_version
+        logger.info(f"Searching for similar to: '{normalized_query}' with thresholds {thresholds}")
 
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                # Получаем все истории для семантического сравнения
-                stories = await conn.fetch('''
-                    SELECT query, answer, normalized_query, score 
-                    FROM user_stories 
+            if self._trgm_available:
+                # Двухэтапный поиск: индекс отбирает ближайших кандидатов по триграммам,
+                # точное сравнение выполняется только для них
+                stories = await pool.fetch('''
+                    SELECT query, answer, normalized_query, score
+                    FROM (
+                        SELECT query, answer, normalized_query, score, is_golden
+                        FROM user_stories
+                        WHERE normalized_query % $1
+                        ORDER BY similarity(normalized_query, $1) DESC
+                        LIMIT $2
+                    ) candidates
                     ORDER BY is_golden DESC, score DESC
-                ''')
+                ''', normalized_query, self.TRGM_CANDIDATES)
+                norms = [row['normalized_query'] for row in stories]
+            else:
+                stories, norms = await self._get_corpus(pool)
 
-                similar = []
-                for row in stories:
-                    stored_norm = row['normalized_query']
-                    
-                    # Улучшенное сравнение с использованием SequenceMatcher
-                    seq_matcher = difflib.SequenceMatcher(None, normalized_query, stored_norm)
-                    sequence_similarity = seq_matcher.ratio()
-                    
-                    # Если схожесть высокая (> 0.95), считаем практически идентичными
-                    if sequence_similarity >= 0.95:
-                        # Для практически идентичных историй возвращаем 99%+ схожесть
-                        similar.append((row['query'], row['answer'], 0.99, row['score']))
-                    elif sequence_similarity >= threshold:
-                        # Используем комбинированную метрику для менее похожих историй
-                        query_words = set(normalized_query.split())
-                        stored_words = set(stored_norm.split())
-                        
-                        common_words = query_words.intersection(stored_words)
-                        total_words = len(query_words.union(stored_words))
-                        
-                        word_similarity = len(common_words) / total_words if total_words > 0 else 0
-                        
-                        # Комбинируем метрики с весом в пользу sequence similarity
-                        combined_similarity = (sequence_similarity * 0.7 + word_similarity * 0.3)
-                        
-                        if combined_similarity >= threshold:
-                            similar.append((row['query'], row['answer'], combined_similarity, row['score']))
+            # Сравнение строк нагружает CPU, выносим его из event loop (все пороги за один раз)
+            ranked = await asyncio.to_thread(
+                lambda: {threshold: self._rank_similar(normalized_query, stories, norms, threshold, limit)
+                         for threshold in thresholds}
+            )
 
-                # Сортируем по убыванию схожести
-                similar.sort(key=lambda x: x[2], reverse=True)
-                return similar[:limit]
+            # Пока шел поиск, в базу могли добавить историю - такой результат не кэшируем
+            if generation == self.stories_version:
+                for threshold, similar in ranked.items():
+                    if len(self._similar_cache) >= self.SIMILAR_CACHE_SIZE:
+                        del self._similar_cache[next(iter(self._similar_cache))]
+                    self._similar_cache[(normalized_query, threshold, limit)] = (tuple(similar), time.monotonic())
+            return ranked
 
         except Exception as e:
             logger.error(f"Error in find_similar: {e}")
-            return []
+            return {threshold: [] for threshold in thresholds}
+
+    async def _get_corpus(self, pool: asyncpg.Pool) -> Tuple[List, List[str]]:
+        """Все истории для семантического сравнения; между записями берутся из кэша"""
+        if self._corpus is None or time.monotonic() - self._corpus_loaded_at > self.CORPUS_TTL:
+            stories = await pool.fetch('''
+                SELECT query, answer, normalized_query, score, is_golden
+                FROM user_stories 
+                ORDER BY is_golden DESC, score DESC
+            ''')
+            self._corpus = (stories, [row['normalized_query'] for row in stories])
+            self._corpus_loaded_at = time.monotonic()
+        return self._corpus
 
     async def add_example(self, query: str, normalized_query: str, answer: str,
                          is_golden: bool, score: int) -> int:
         """Добавление примера - совместимый интерфейс"""
+        corpus = self._corpus
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                row = await conn.fetchrow('''
-                    INSERT INTO user_stories
-                    (query, normalized_query, answer, is_golden, score, usage_count)
-                    VALUES ($1, $2, $3, $4, $5, 0)
-                    RETURNING id
-                ''', query, normalized_query, answer, is_golden, score)
+            row = await pool.fetchrow('''
+                INSERT INTO user_stories
+                (query, normalized_query, answer, is_golden, score, usage_count)
+                VALUES ($1, $2, $3, $4, $5, 0)
+                RETURNING id, query, answer, normalized_query, score, is_golden
+            ''', query, normalized_query, answer, is_golden, score)
+
+            # Вставленная строка уже на руках: дополняем кэш корпуса вместо полной перезагрузки.
+            # Если корпус успели перечитать во время вставки, строка могла в него попасть - сбрасываем
+            if corpus is not None and self._corpus is corpus:
+                self._corpus = self._corpus_with(corpus, row)
+            else:
+                self._corpus = None
+            # Сбрасываем после вставки: поиск, прошедший во время INSERT, не закэширует
+            # результат без новой строки
+            self._invalidate_similar()
                 
-                logger.info(f"Added example with ID {row['id']}")
-                return row['id']
+            logger.info(f"Added example with ID {row['id']}")
+            return row['id']
         except Exception as e:
             logger.error(f"Error adding example: {e}")
             raise
@@ -156,18 +260,32 @@ class ExamplesDB:
         """Пакетное добавление примеров - совместимый интерфейс"""
         if not examples:
             return
-            
+
         try:
             pool = await self.get_pool()
             async with pool.acquire() as conn:
-                async with conn.transaction():
-                    for example in examples:
-                        query, norm, answer, is_golden, score = example
-                        await conn.execute('''
+                try:
+                    # Бинарный COPY: все строки одним потоком вместо INSERT на каждую
+                    await conn.copy_records_to_table(
+                        'user_stories',
+                        records=[(query, norm, answer, is_golden, score, 0)
+                                 for query, norm, answer, is_golden, score in examples],
+                        columns=['query', 'normalized_query', 'answer', 'is_golden', 'score', 'usage_count']
+                    )
+                except asyncpg.FeatureNotSupportedError as e:
+                    # Некоторые прокси/совместимые с PostgreSQL сервера не поддерживают COPY:
+                    # один подготовленный INSERT для всех строк
+                    logger.warning(f"COPY not supported, falling back to executemany: {e}")
+                    async with conn.transaction():
+                        await conn.executemany('''
                             INSERT INTO user_stories
                             (query, normalized_query, answer, is_golden, score, usage_count)
                             VALUES ($1, $2, $3, $4, $5, 0)
-                        ''', query, norm, answer, is_golden, score)
+                        ''', examples)
+
+            # Сбрасываем кэши после записи, а не до: иначе их успеют заполнить без новых строк
+            self._corpus = None
+            self._invalidate_similar()
                         
             logger.info(f"Added {len(examples)} examples in batch")
         except Exception as e:
@@ -175,68 +293,106 @@ class ExamplesDB:
             raise
 
     async def increment_usage_count(self, normalized_query: str) -> None:
-        """Увеличение счетчика использования - совместимый интерфейс"""
+        """Увеличение счетчика использования - совместимый интерфейс.
+
+        Счетчики копятся в памяти и пишутся одним UPDATE через USAGE_FLUSH_DELAY секунд,
+        ответ пользователю не ждет записи в БД.
+        """
+        self._usage_buffer[normalized_query] += 1
+        if self._usage_flush_task is None or self._usage_flush_task.done():
+            self._usage_flush_task = asyncio.create_task(self._flush_usage_later())
+
+    async def _flush_usage_later(self) -> None:
+        try:
+            await asyncio.wait_for(self._usage_flush_now.wait(), self.USAGE_FLUSH_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        await self.flush_usage_counts()
+
+    async def flush_usage_counts(self) -> None:
+        """Записать накопленные счетчики использования одним запросом"""
+        if not self._usage_buffer:
+            return
+
+        buffer, self._usage_buffer = self._usage_buffer, Counter()
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                await conn.execute('''
-                    UPDATE user_stories
-                    SET usage_count = usage_count + 1, 
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE normalized_query = $1
-                ''', normalized_query)
+            await pool.execute('''
+                UPDATE user_stories AS u
+                SET usage_count = u.usage_count + v.hits,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM unnest($1::text[], $2::int[]) AS v(normalized_query, hits)
+                WHERE u.normalized_query = v.normalized_query
+            ''', list(buffer.keys()), list(buffer.values()))
         except Exception as e:
             logger.error(f"Error incrementing usage count: {e}")
-            raise
+            # Не теряем счетчики - попробуем записать их со следующей пачкой
+            self._usage_buffer.update(buffer)
 
     async def get_statistics(self) -> dict:
         """Получение статистики - совместимый интерфейс"""
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                total = await conn.fetchval("SELECT COUNT(*) FROM user_stories")
-                golden = await conn.fetchval("SELECT COUNT(*) FROM user_stories WHERE is_golden = TRUE")
-                avg_score = await conn.fetchval("SELECT AVG(score) FROM user_stories")
-                
-                return {
-                    "total_stories": total,
-                    "golden_stories": golden,
-                    "average_score": round(float(avg_score or 0), 2),
-                }
+            # Все агрегаты за один проход по таблице и один round-trip
+            row = await pool.fetchrow('''
+                SELECT COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE is_golden) AS golden,
+                       AVG(score) AS avg_score
+                FROM user_stories
+            ''')
+            
+            return {
+                "total_stories": row['total'],
+                "golden_stories": row['golden'],
+                "average_score": round(float(row['avg_score'] or 0), 2),
+            }
         except Exception as e:
             logger.error(f"Error getting statistics: {e}")
             return {"total_stories": 0, "golden_stories": 0, "average_score": 0}
 
-    async def get_all_stories(self, page: int = 0, page_size: int = 10) -> List[Dict]:
-        """Получить все истории с пагинацией - совместимый интерфейс"""
+    async def get_all_stories(self, page: int = 0, page_size: int = 10,
+                              after: Optional[Tuple] = None) -> List[asyncpg.Record]:
+        """Получить все истории с пагинацией - совместимый интерфейс.
+
+        after - ключ (created_at, score, id) последней истории предыдущей страницы:
+        с ним страница читается по индексу без OFFSET; без него - по номеру страницы.
+        """
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
+            if after is not None:
+                rows = await pool.fetch('''
+                    SELECT id, query, answer, is_golden, score, created_at
+                    FROM user_stories
+                    WHERE (created_at, score, id) < ($1, $2, $3)
+                    ORDER BY created_at DESC, score DESC, id DESC
+                    LIMIT $4
+                ''', *after, page_size)
+            else:
                 offset = page * page_size
-                rows = await conn.fetch('''
+                rows = await pool.fetch('''
                     SELECT id, query, answer, is_golden, score, created_at
                     FROM user_stories
-                    ORDER BY created_at DESC, score DESC
+                    ORDER BY created_at DESC, score DESC, id DESC
                     LIMIT $1 OFFSET $2
                 ''', page_size, offset)
-                
-                return [dict(row) for row in rows]
+            
+            # Record поддерживает row['key'] и row.get() - копировать в dict незачем
+            return rows
         except Exception as e:
             logger.error(f"Error getting all stories: {e}")
             return []
 
-    async def get_story_by_id(self, story_id: int) -> Optional[Dict]:
+    async def get_story_by_id(self, story_id: int) -> Optional[asyncpg.Record]:
         """Получить историю по ID - совместимый интерфейс"""
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                row = await conn.fetchrow('''
-                    SELECT id, query, answer, is_golden, score, created_at
-                    FROM user_stories
-                    WHERE id = $1
-                ''', story_id)
-                
-                return dict(row) if row else None
+            row = await pool.fetchrow('''
+                SELECT id, query, answer, is_golden, score, created_at
+                FROM user_stories
+                WHERE id = $1
+            ''', story_id)
+            
+            return row
         except Exception as e:
             logger.error(f"Error getting story by ID: {e}")
             return None
@@ -245,14 +401,22 @@ class ExamplesDB:
         """Получить общее количество историй - совместимый интерфейс"""
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                return await conn.fetchval("SELECT COUNT(*) FROM user_stories")
+            return await pool.fetchval("SELECT COUNT(*) FROM user_stories")
         except Exception as e:
             logger.error(f"Error getting total stories count: {e}")
             return 0
 
     async def close(self) -> None:
         """Улучшенное закрытие соединений"""
+        # Отложенную запись счетчиков выполняем сразу, пока пул еще открыт. Задачу не
+        # отменяем: если она уже внутри UPDATE, отмена потеряла бы забранные ею счетчики
+        if self._usage_flush_task and not self._usage_flush_task.done():
+            self._usage_flush_now.set()
+            await self._usage_flush_task
+            self._usage_flush_now.clear()
+        # Остаток (например, вернувшийся после неудачной записи) - после задачи, не параллельно
+        await self.flush_usage_counts()
+
         if self._pool:
             try:
                 # Даем время на завершение текущих операций
@@ -264,33 +428,88 @@ class ExamplesDB:
 
     async def health_check(self) -> bool:
         """Проверка здоровья базы данных - совместимый интерфейс"""
+        checked_at, healthy = self._health_cache
+        if time.monotonic() - checked_at < self.HEALTH_CHECK_TTL:
+            return healthy
         try:
             pool = await self.get_pool()
-            async with pool.acquire() as conn:
-                result = await conn.fetchval("SELECT 1")
-                return result == 1
+            result = await pool.fetchval("SELECT 1")
+            healthy = result == 1
         except Exception as e:
             logger.error(f"Database health check failed: {e}")
-            return False
+            healthy = False
+        self._health_cache = (time.monotonic(), healthy)
+        return healthy
+
+    def _invalidate_similar(self) -> None:
+        """Сброс кэша результатов find_similar после записи в базу"""
+        self.stories_version += 1
+        self._similar_cache.clear()
+
+    @staticmethod
+    def _corpus_with(corpus: Tuple[List, List[str]], row) -> Tuple[List, List[str]]:
+        """Новый корпус со строкой row на своем месте (is_golden DESC, score DESC)"""
+        stories, norms = corpus
+        position = bisect.bisect_right(
+            stories, (not row['is_golden'], -row['score']),
+            key=lambda story: (not story['is_golden'], -story['score'])
+        )
+        # Копии, а не вставка на месте: старые списки может читать поиск в другом потоке
+        return (stories[:position] + [row] + stories[position:],
+                norms[:position] + [row['normalized_query']] + norms[position:])
+
+    @staticmethod
+    def _rank_similar(normalized_query: str, stories: List, norms: List[str],
+                      threshold: float, limit: int) -> List[Tuple]:
+        """Оценка схожести запроса с каждой историей (выполняется в отдельном потоке)"""
+        similar = []
+        query_words = _word_set(normalized_query)
 
+        # Посимвольная схожесть со всеми историями одним вызовом rapidfuzz (цикл на C++,
+        # без GIL); ниже порога отсекаются сразу. Небольшой допуск компенсирует
+        # погрешность threshold * 100, точная проверка порога - ниже
+        matches = process.extract(
+            normalized_query,
+            norms,
+            scorer=fuzz.ratio,
+            score_cutoff=threshold * 100 - 1e-6,
+            limit=None
+        )
+
+        # Идем в порядке выдачи БД, чтобы при равной схожести сохранялся приоритет golden/score
+        for stored_norm, ratio, index in sorted(matches, key=lambda match: match[2]):
+            row = stories[index]
+            sequence_similarity = ratio / 100
+            
+            # Если схожесть высокая (> 0.95), считаем практически идентичными
+            if sequence_similarity >= 0.95:
+                # Для практически идентичных историй возвращаем 99%+ схожесть
+                similar.append((row['query'], row['answer'], 0.99, row['score']))
+            elif sequence_similarity >= threshold:
+                # Используем комбинированную метрику для менее похожих историй
+                stored_words = _word_set(stored_norm)
+                
+                common_words = query_words.intersection(stored_words)
+                total_words = len(query_words.union(stored_words))
+                
+                word_similarity = len(common_words) / total_words if total_words > 0 else 0
+                
+                # Комбинируем метрики с весом в пользу sequence similarity
+                combined_similarity = (sequence_similarity * 0.7 + word_similarity * 0.3)
+                
+                if combined_similarity >= threshold:
+                    similar.append((row['query'], row['answer'], combined_similarity, row['score']))
+
+        # Лучшие limit по убыванию схожести без полной сортировки (порядок равных сохраняется)
+        return heapq.nlargest(limit, similar, key=lambda x: x[2])
+
+    @staticmethod
     @lru_cache(maxsize=1000)
-    def _normalize_query(self, text: str) -> str:
+    def _normalize_query(text: str) -> str:
         """Улучшенная нормализация для поиска - игнорирует знаки препинания и регистр"""
         if not text:
             return ""
         
-        text = text.lower().strip()
-        
-        # удаление знаков препинания
-        import string
-        punctuation_chars = string.punctuation + '«»„“‚‘‛"'
-        text = text.translate(str.maketrans('', '', punctuation_chars))
-        
-        # Удаляем лишние пробелы
-        text = ' '.join(text.split())
-        
-        # Дополнительная нормализация для User Stories
-        text = re.sub(r'\s*,\s*', ' ', text)  # заменяем запятые на пробелы
-        text = re.sub(r'\s+', ' ', text)  # удаляем множественные пробелы
-        
-        return text
+        # Удаление знаков препинания (запятые тоже) и схлопывание пробелов
+        text = text.lower().translate(_PUNCT_TABLE)
+        return ' '.join(text.split())
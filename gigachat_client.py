@@ -1,12 +1,15 @@
 import asyncio
 import base64
+import hashlib
+import heapq
+import json
 import time
 import uuid
 import httpx
 from httpx import AsyncClient
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator
 
 from config import Config
 
@@ -34,6 +37,18 @@ class ServerError(GigaChatError):
 class GigaChatClient:
     """Асинхронный клиент для GigaChat API с улучшенной обработкой ошибок и оптимизациями"""
 
+    HEALTH_CHECK_TTL = 15  # секунд между реальными проверками
+
+    # Параметры генерации (входят и в payload, и в ключ кэша ответов)
+    TEMPERATURE = 0.7
+    MAX_TOKENS = 512  # лимит для экономии
+    TOP_P = 0.9
+
+    RESPONSE_CACHE_SIZE = 100
+    # TTL ответа = время генерации * множитель в границах LLM_CACHE_TTL_MIN..MAX:
+    # чем дороже ответ, тем дольше его стоит переиспользовать
+    RESPONSE_CACHE_TTL_FACTOR = 30
+
     def __init__(self):
         self.auth_credentials = Config.get_auth_credentials()
         self.scope = Config.GIGACHAT_SCOPE
@@ -43,6 +58,9 @@ class GigaChatClient:
         self.token_url = Config.GIGACHAT_AUTH_URL
         self.api_base = Config.GIGACHAT_API_URL
 
+        # Общий HTTP-клиент: keep-alive соединения переиспользуются между запросами
+        self._client: Optional[AsyncClient] = None
+
         # Token management
         self._access_token: Optional[str] = None
         self._token_expiry: float = 0
@@ -52,12 +70,26 @@ class GigaChatClient:
         self._error_count = 0
         self._last_request_time = 0
         self._token_cache_hits = 0
-        self._response_cache = {}  # Кэш ответов для одинаковых запросов
+        # Кэш ответов для одинаковых запросов: LRU на обычном dict (порядок вставки),
+        # "перемещение в конец" - pop + повторная вставка, вытеснение - первый ключ
+        self._response_cache: Dict[bytes, Dict[str, Any]] = {}
+        # Очередь истечения TTL (min-heap по expires_at): устаревшие ответы удаляются сразу,
+        # а не занимают место, пока их не вытеснит LRU
+        self._response_expiry: List[tuple[float, bytes]] = []
+        # При temperature > 0 ответ случаен: кэш закрепил бы один сэмпл
+        # (например, повторное "улучшить" возвращало бы тот же вариант)
+        self._cache_responses = self.TEMPERATURE <= Config.LLM_CACHE_TEMPERATURE_THRESHOLD
+
+        # Ограничение одновременных запросов к LLM (backpressure вместо 429 от провайдера)
+        self._llm_semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_LLM)
 
         # Circuit breaker state (упрощенная реализация)
         self._circuit_open = False
         self._circuit_open_until = 0
 
+        # Кэш результата health_check: (время проверки, результат); -inf - проверки еще не было
+        self._health_cache = (float('-inf'), False)
+
         # Performance monitoring
         self._total_tokens_sent = 0
         self._total_tokens_received = 0
@@ -104,11 +136,10 @@ class GigaChatClient:
             }
             payload = {"scope": self.scope}
 
-            async with AsyncClient(verify=self.verify, timeout=30.0) as client:
-                resp = await client.post(
-                    self.token_url, headers=headers, data=payload
-                )
-                resp.raise_for_status()
+            resp = await self._get_client().post(
+                self.token_url, headers=headers, data=payload, timeout=30.0
+            )
+            resp.raise_for_status()
 
             j = resp.json()
             access = j.get("access_token")
@@ -149,6 +180,23 @@ class GigaChatClient:
             logger.error(f"Unexpected error getting token: {e}")
             raise
 
+    def _get_client(self) -> AsyncClient:
+        """HTTP-клиент, общий для всех запросов (создается при первом обращении)"""
+        if self._client is None or self._client.is_closed:
+            self._client = AsyncClient(
+                verify=self.verify,
+                timeout=60.0,
+                # Параллельные запросы мультиплексируются в одном TLS-соединении;
+                # если сервер не предложит h2 через ALPN, httpx останется на HTTP/1.1
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=Config.GIGACHAT_MAX_CONNECTIONS,
+                    max_keepalive_connections=Config.GIGACHAT_MAX_KEEPALIVE,
+                    keepalive_expiry=Config.GIGACHAT_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
     def _handle_circuit_breaker_failure(self):
         """Обработка failures для circuit breaker"""
         # Простая реализация circuit breaker
@@ -158,10 +206,30 @@ class GigaChatClient:
             self._circuit_open_until = time.time() + 300  # 5 минут timeout
             logger.warning("Circuit breaker opened due to consecutive failures")
 
-    def _get_cache_key(self, messages: List[Dict]) -> str:
-        """Генерация ключа кэша для сообщений"""
-        content = "".join(msg.get("content", "") for msg in messages)
-        return str(hash(content))
+    def _get_cache_key(self, messages: List[Dict]) -> bytes:
+        """Генерация ключа кэша: модель, параметры генерации и сообщения с ролями"""
+        # blake2b вместо hash(): ключ одинаков между перезапусками и процессами.
+        # Сообщения подаются в хэш по частям - без склейки всей переписки в одну строку
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{Config.MODEL_NAME}|{self.TEMPERATURE}|{self.MAX_TOKENS}|{self.TOP_P}".encode("utf-8"))
+        for msg in messages:
+            for field in (msg.get("role", ""), msg.get("content", "")):
+                data = field.encode("utf-8")
+                # Длина перед каждым полем: ("ab", "c") и ("a", "bc") дают разные ключи
+                h.update(len(data).to_bytes(4, "little"))
+                h.update(data)
+        # Кэш живет только в памяти, поэтому сырой digest без перевода в hex-строку
+        return h.digest()
+
+    def _evict_expired_responses(self, now: float) -> None:
+        """Удалить из кэша ответы с истекшим TTL (O(log N) на запись)"""
+        expiry = self._response_expiry
+        while expiry and expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(expiry)
+            entry = self._response_cache.get(key)
+            # Запись могла быть перезаписана с новым сроком или уже вытеснена LRU
+            if entry is not None and entry['expires_at'] == expires_at:
+                del self._response_cache[key]
 
     def _estimate_token_count(self, text: str) -> int:
         """Примерная оценка количества токенов"""
@@ -187,12 +255,15 @@ class GigaChatClient:
                 logger.info("Circuit breaker closed after timeout")
 
         # Проверяем кэш перед обращением к API
-        cache_key = self._get_cache_key(messages)
-        if cache_key in self._response_cache:
-            logger.debug("Using cached response for completion")
-            cached_data = self._response_cache[cache_key]
-            # Проверяем TTL кэша (5 минут)
-            if time.time() - cached_data['timestamp'] < 300:
+        if self._cache_responses:
+            now = time.monotonic()
+            self._evict_expired_responses(now)
+            cache_key = self._get_cache_key(messages)
+            cached_data = self._response_cache.pop(cache_key, None)
+            if cached_data is not None and now < cached_data['expires_at']:
+                logger.debug("Using cached response for completion")
+                # Возвращаем в конец (самый свежий)
+                self._response_cache[cache_key] = cached_data
                 return cached_data['response'], messages
 
         token = await self.get_token()
@@ -208,9 +279,9 @@ class GigaChatClient:
         payload = {
             "model": Config.MODEL_NAME,
             "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 512,  # лимит для экономии
-            "top_p": 0.9
+            "temperature": self.TEMPERATURE,
+            "max_tokens": self.MAX_TOKENS,
+            "top_p": self.TOP_P
         }
 
         # Логируем использование токенов
@@ -219,8 +290,12 @@ class GigaChatClient:
         self._total_tokens_sent += input_tokens
 
         try:
-            async with AsyncClient(verify=self.verify, timeout=60.0) as client:
+            client = self._get_client()
+            async with self._llm_semaphore:
+                # Время генерации считаем без ожидания семафора
+                started = time.monotonic()
                 resp = await client.post(url, headers=headers, json=payload)
+                generation_time = time.monotonic() - started
 
                 # Обработка специфичных HTTP ошибок
                 if resp.status_code == 401:
@@ -250,18 +325,21 @@ class GigaChatClient:
 
             logger.debug(f"LLM request: {input_tokens} in, {output_tokens} out tokens")
 
-            # Кэшируем успешный ответ
-            self._response_cache[cache_key] = {
-                'response': (answer, messages),
-                'timestamp': time.time()
-            }
-
-            # Ограничиваем размер кэша
-            if len(self._response_cache) > 100:
-                # Удаляем самые старые записи
-                oldest_key = min(self._response_cache.keys(),
-                               key=lambda k: self._response_cache[k]['timestamp'])
-                del self._response_cache[oldest_key]
+            # Кэшируем только успешно разобранный ответ (в конец - самый свежий)
+            if self._cache_responses:
+                ttl = min(max(generation_time * self.RESPONSE_CACHE_TTL_FACTOR, Config.LLM_CACHE_TTL_MIN),
+                          Config.LLM_CACHE_TTL_MAX)
+                expires_at = time.monotonic() + ttl
+                self._response_cache.pop(cache_key, None)
+                self._response_cache[cache_key] = {
+                    'response': answer,
+                    'expires_at': expires_at
+                }
+                heapq.heappush(self._response_expiry, (expires_at, cache_key))
+
+                # Ограничиваем размер кэша: вытесняем давно не использованную запись за O(1)
+                if len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+                    del self._response_cache[next(iter(self._response_cache))]
 
             # Сброс счетчика ошибок при успешном запросе
             self._error_count = max(0, self._error_count - 1)
@@ -292,15 +370,111 @@ class GigaChatClient:
         result = await self.get_chat_completion(messages)
         return result[0] if isinstance(result, tuple) else result
 
+    async def chat_stream(self, messages: List[Dict]) -> AsyncIterator[str]:
+        """Потоковый ответ от GigaChat (SSE): отдает фрагменты текста по мере генерации"""
+        self._request_count += 1
+        self._last_request_time = time.time()
+
+        # Проверка circuit breaker
+        if self._circuit_open:
+            if time.time() < self._circuit_open_until:
+                raise GigaChatError("Circuit breaker is open")
+            else:
+                self._circuit_open = False
+                logger.info("Circuit breaker closed after timeout")
+
+        token = await self.get_token()
+        url = f"{self.api_base}/chat/completions"
+
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+            "Authorization": f"Bearer {token}",
+        }
+
+        payload = {
+            "model": Config.MODEL_NAME,
+            "messages": messages,
+            "temperature": self.TEMPERATURE,
+            "max_tokens": self.MAX_TOKENS,
+            "top_p": self.TOP_P,
+            "stream": True
+        }
+
+        input_text = " ".join(msg.get("content", "") for msg in messages)
+        input_tokens = self._estimate_token_count(input_text)
+        self._total_tokens_sent += input_tokens
+
+        parts = []
+        try:
+            client = self._get_client()
+            # Слот занят, пока поток открыт (в том числе между yield): потребитель
+            # не должен делать долгих операций между фрагментами
+            async with self._llm_semaphore:
+                async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                    if resp.status_code == 401:
+                        logger.warning("Token expired, refreshing...")
+                        self._access_token = None
+                        raise TokenExpiredError("Access token expired")
+                    elif resp.status_code == 429:
+                        raise RateLimitError("Rate limit exceeded")
+                    elif resp.status_code >= 500:
+                        logger.error(f"Server error: {resp.status_code}")
+                        raise ServerError(f"Server error: {resp.status_code}")
+
+                    resp.raise_for_status()
+
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+
+                        choices = json.loads(data).get("choices")
+                        if not choices:
+                            continue
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+
+            output_tokens = self._estimate_token_count("".join(parts))
+            self._total_tokens_received += output_tokens
+            logger.debug(f"LLM stream: {input_tokens} in, {output_tokens} out tokens")
+
+            self._error_count = max(0, self._error_count - 1)
+
+        except httpx.HTTPStatusError as e:
+            self._error_count += 1
+            logger.error(f"HTTP error in chat stream: {e.response.status_code}")
+            if e.response.status_code >= 500:
+                self._handle_circuit_breaker_failure()
+            raise
+        except httpx.RequestError as e:
+            self._error_count += 1
+            logger.error(f"Request error in chat stream: {e}")
+            self._handle_circuit_breaker_failure()
+            raise
+        except Exception as e:
+            self._error_count += 1
+            logger.error(f"Unexpected error in chat stream: {e}")
+            raise
+
     async def health_check(self) -> bool:
-        """Проверка здоровья клиента"""
+        """Проверка здоровья клиента (результат кэшируется на HEALTH_CHECK_TTL секунд)"""
+        checked_at, healthy = self._health_cache
+        if time.monotonic() - checked_at < self.HEALTH_CHECK_TTL:
+            return healthy
         try:
             # Быстрая проверка получения токена
             token = await self.get_token()
-            return bool(token)
+            healthy = bool(token)
         except Exception as e:
             logger.error(f"Health check failed: {e}")
-            return False
+            healthy = False
+        self._health_cache = (time.monotonic(), healthy)
+        return healthy
 
     def get_stats(self) -> Dict[str, Any]:
         """Получить статистику клиента"""
@@ -342,13 +516,24 @@ class GigaChatClient:
     def clear_cache(self):
         """Очистка кэшей"""
         self._response_cache.clear()
+        self._response_expiry.clear()
         self._access_token = None
         self._token_expiry = 0
         logger.info("Client cache cleared")
 
     async def close(self):
         """Закрытие клиента"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
         self._access_token = None
         self._token_expiry = 0
         self._response_cache.clear()
+        self._response_expiry.clear()
         logger.info("GigaChat client closed")
+
+    async def __aenter__(self) -> "GigaChatClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
@@ -1,9 +1,18 @@
+import asyncio
+import csv
 import io
+import hashlib
 import logging
 import re
+import time
 
-from bot import LRUCache
+from bot import HistoryEntry
+from collections import deque
+from contextlib import aclosing
+from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime
+from typing import Optional
 from telegram import Update, InputFile
 from telegram.ext import (
     Application,
@@ -14,7 +23,7 @@ from telegram.ext import (
     ContextTypes,
 )
 
-from telegram.error import BadRequest
+from telegram.error import BadRequest, TelegramError
 from keyboards import (
     main_menu_keyboard,
     help_keyboard,
@@ -41,8 +50,53 @@ from utils import (
 
 logger = logging.getLogger("handlers")
 
-# Кэш для валидации User Stories
-_user_story_cache = LRUCache(max_size=1000, ttl=3600)    #Dict[str, bool] = {}
+# Шаблоны User Story (компилируются один раз при импорте)
+_STORY_RE = re.compile(
+    r"^как\s+.+?,\s*(?:"
+    r"я\s+хочу\s+.+?,\s*(?:чтобы|что\s+бы)"  # оригинальный и с опечаткой
+    r"|мне\s+нужно\s+.+?,\s*чтобы"  # альтернативная формулировка
+    r"|я\s+могу\s+.+?,\s*чтобы"  # еще вариант
+    r")\s+.+?$"
+)
+# Оценка вида "Оценка: 4/6" в тексте анализа
+_SCORE_LABEL_RE = re.compile(r'Оценка:\s*(\d/6)')
+# Признаки того, что текст хоть немного похож на User Story
+_STORY_HINT_RE = re.compile(r"как|хочу|чтобы|что бы|мне нужно", re.IGNORECASE)
+
+# Минимальный интервал между обновлениями сообщения при потоковом ответе LLM (сек)
+_STREAM_EDIT_INTERVAL = 1.5
+
+# Шаблоны /stats: текст фиксирован, подставляются только значения
+_STATS_TEMPLATE = (
+    "📊 *Статистика системы:*\n\n"
+    "• ⏱ Аптайм: {}\n"
+    "• 👥 Пользователей: {}\n"
+    "• 📚 Всего историй: {}\n"
+    "• ⭐ Золотых историй: {}\n"
+    "• 📈 Общее использование: {}\n"
+    "• 🎯 Средний score: {:.2f}\n"
+    "• 💾 Эффективность кэша: {:.1%}"
+)
+_STATS_ERROR_TEXT = "📊 *Статистика системы:*\n\n❌ Ошибка при получении статистики"
+_LLM_STATS_TEMPLATE = (
+    "\n\n🤖 *Статистика LLM:*\n"
+    "• 📞 Всего запросов: {}\n"
+    "• 💾 Кэш токенов: {:.1%}\n"
+    "• ⚡ Кэш ответов: {} записей\n"
+    "• 📨 Токены отправлено: {}\n"
+    "• 📩 Токены получено: {}"
+)
+
+# Глубина истории пользователя (для fallback-хранения в bot_data)
+_MAX_HISTORY_DEPTH = 50
+
+# Версия истории в цепочке улучшений (slots - без __dict__ на каждую запись)
+@dataclass(slots=True, frozen=True)
+class StoryVersion:
+    story: str
+    analysis: Optional[str]
+    timestamp: str
+    version: int
 
 # Класс для хранения цепочки улучшений
 class ImprovementChain:
@@ -52,12 +106,12 @@ class ImprovementChain:
     def add_version(self, story: str, analysis: str = None, timestamp: str = None):
         if timestamp is None:
             timestamp = datetime.now().isoformat()
-        self.versions.append({
-            'story': story,
-            'analysis': analysis,
-            'timestamp': timestamp,
-            'version': len(self.versions) + 1
-        })
+        self.versions.append(StoryVersion(
+            story=story,
+            analysis=analysis,
+            timestamp=timestamp,
+            version=len(self.versions) + 1
+        ))
 
     def get_initial(self):
         return self.versions[0] if self.versions else None
@@ -101,7 +155,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             }
 
         if user_id not in context.bot_data['user_history']:
-            context.bot_data['user_history'][user_id] = []
+            context.bot_data['user_history'][user_id] = deque(maxlen=_MAX_HISTORY_DEPTH)
             context.bot_data['stats']['user_sessions'] += 1
 
         welcome_text = (
@@ -174,29 +228,28 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         
         stats_data = await bot.get_bot_stats(db, llm_client)
 
-        stats_text = "📊 *Статистика системы:*\n\n"
-
         if 'error' in stats_data:
-            stats_text += "❌ Ошибка при получении статистики"
+            system_text = _STATS_ERROR_TEXT
         else:
-            stats_text += (
-                f"• ⏱ Аптайм: {stats_data.get('uptime', 'N/A')}\n"
-                f"• 👥 Пользователей: {stats_data.get('active_users', 0)}\n"
-                f"• 📚 Всего историй: {stats_data.get('total_stories', 0)}\n"
-                f"• ⭐ Золотых историй: {stats_data.get('golden_stories', 0)}\n"
-                f"• 📈 Общее использование: {stats_data.get('total_messages', 0)}\n"
-                f"• 🎯 Средний score: {stats_data.get('average_score', 0):.2f}\n"
-                f"• 💾 Эффективность кэша: {stats_data.get('cache_hit_rate', 0):.1%}"
+            system_text = _STATS_TEMPLATE.format(
+                stats_data.get('uptime', 'N/A'),
+                stats_data.get('active_users', 0),
+                stats_data.get('total_stories', 0),
+                stats_data.get('golden_stories', 0),
+                stats_data.get('total_messages', 0),
+                stats_data.get('average_score', 0),
+                stats_data.get('cache_hit_rate', 0)
             )
 
         # Получаем статистику LLM клиента
         llm_stats = llm_client.get_stats()
-        stats_text += "\n\n🤖 *Статистика LLM:*\n"
-        stats_text += f"• 📞 Всего запросов: {llm_stats.get('total_requests', 0)}\n"
-        stats_text += f"• 💾 Кэш токенов: {llm_stats.get('token_cache_hit_rate', 0):.1%}\n"
-        stats_text += f"• ⚡ Кэш ответов: {llm_stats.get('response_cache_size', 0)} записей\n"
-        stats_text += f"• 📨 Токены отправлено: {llm_stats.get('total_tokens_sent', 0)}\n"
-        stats_text += f"• 📩 Токены получено: {llm_stats.get('total_tokens_received', 0)}"
+        stats_text = system_text + _LLM_STATS_TEMPLATE.format(
+            llm_stats.get('total_requests', 0),
+            llm_stats.get('token_cache_hit_rate', 0),
+            llm_stats.get('response_cache_size', 0),
+            llm_stats.get('total_tokens_sent', 0),
+            llm_stats.get('total_tokens_received', 0)
+        )
 
         # Определяем, откуда пришел запрос
         if update.message:
@@ -226,43 +279,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         text = update.message.text.strip()
 
-        # Сохраняем исходную историю
+        # Сохраняем исходную историю и нормализуем ее один раз на входе
+        norm = normalize_text(text)
         context.user_data['initial_story'] = text
+        context.user_data['initial_norm'] = norm
 
-        # Проверяем кэш бота перед анализом
-        cache_key = f"analysis_{hash(text.lower().strip())}"
-        cached_analysis = context.bot_data.get('analysis_cache', {}).get(cache_key)
-
-        if cached_analysis:
-            # Увеличиваем счетчик попаданий в кэш
-            if 'bot' in context.bot_data:
-                context.bot_data['bot'].stats['cache_hits'] += 1
-            logger.info("Using cached analysis for user story")
-            # Используем кэшированный анализ
-            context.user_data['last_analysis'] = cached_analysis
-            keyboard = analysis_result_keyboard(
-                show_add_to_db=should_show_add_to_db_button(cached_analysis['analysis']),
-                has_improvement_history='improvement_chain' in context.user_data,
-                analysis_text=cached_analysis['analysis']
-            )
-
-            response_text = format_analysis_for_display(cached_analysis['analysis'], text)
-            await update.message.reply_text(
-                response_text,
-                reply_markup=keyboard,
-                parse_mode='Markdown'
-            )
-            return
-
-        # Увеличиваем счетчик промахов кэша
-        if 'bot' in context.bot_data:
-            context.bot_data['bot'].stats['cache_misses'] += 1
+        # Кэш анализов проверяет _analyze_user_story - одна проверка для сообщений и callback'ов
 
         # Более информативное сообщение о невалидности
         if not _is_valid_user_story(text):
             # Проверяем, похоже ли хоть немного на User Story
-            text_lower = text.lower()
-            has_structure = any(word in text_lower for word in ["как", "хочу", "чтобы", "что бы", "мне нужно"])
+            # Регистр игнорирует сама регулярка - без лишней копии text.lower()
+            has_structure = _STORY_HINT_RE.search(text) is not None
 
             if has_structure and len(text) > 15:
                 # Если похоже, но не прошло валидацию - все равно анализируем
@@ -270,7 +298,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     "⚠️ Формулировка немного нестандартная, но я попробую проанализировать...",
                     reply_markup=main_menu_keyboard()
                 )
-                await _analyze_user_story(update, context, text)
+                await _analyze_user_story(update, context, text, norm=norm)
             else:
                 await update.message.reply_text(
                     "❌ Это не похоже на User Story.\n\n*Правильный формат:*\n"
@@ -284,7 +312,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     parse_mode='Markdown'
                 )
         else:
-            await _analyze_user_story(update, context, text)
+            await _analyze_user_story(update, context, text, norm=norm)
 
     except Exception as e:
         logger.error(f"Error in message handler: {e}")
@@ -293,46 +321,34 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=navigation_keyboard()
         )
 
+@lru_cache(maxsize=1000)
 def _is_valid_user_story(text: str) -> bool:
-    """Проверка валидности User Story с улучшенной логикой и кэшированием"""
+    """Проверка валидности User Story с улучшенной логикой и кэшированием (чистая функция)"""
     if len(text) > 2000:  # увеличили лимит
         return False
 
-    # Проверка кэша - используем LRUCache вместо простого словаря
-    cache_key = text.lower().strip()
-    cached_result = _user_story_cache.get(cache_key)
-    if cached_result is not None:
-        return cached_result
+    # Короткий текст не проходит ни шаблон, ни проверку по ключевым словам (минимальная длина 21) -
+    # отсекаем до приведения к нижнему регистру
+    text = text.strip()
+    if len(text) <= 20:
+        return False
 
-    # Более гибкая проверка паттерна
-    patterns = [
-        r"^как\s+.+?,\s*я\s+хочу\s+.+?,\s*чтобы\s+.+?$",  # оригинальный
-        r"^как\s+.+?,\s*я\s+хочу\s+.+?,\s*что\s+бы\s+.+?$",  # с опечаткой
-        r"^как\s+.+?,\s*мне\s+нужно\s+.+?,\s*чтобы\s+.+?$",  # альтернативная формулировка
-        r"^как\s+.+?,\s*я\s+могу\s+.+?,\s*чтобы\s+.+?$",  # еще вариант
-    ]
+    text_lower = text.lower()
 
-    text_lower = text.lower().strip()
-    is_valid = any(re.match(pattern, text_lower) for pattern in patterns)
+    # Более гибкая проверка паттерна
+    is_valid = _STORY_RE.match(text_lower) is not None
 
     # Если не прошло по паттерну, но содержит ключевые слова - считаем валидным
     if not is_valid:
-        keywords = ["как", "хочу", "чтобы"]
-        has_keywords = all(keyword in text_lower for keyword in keywords) or \
-                     ("как" in text_lower and "хочу" in text_lower and "что бы" in text_lower)
-
-        if has_keywords and len(text_lower) > 20:  # минимальная длина
-            is_valid = True
-
-    # Сохраняем в кэш (LRUCache автоматически управляет размером и TTL)
-    _user_story_cache.set(cache_key, is_valid)
+        is_valid = "как" in text_lower and "хочу" in text_lower and \
+                   ("чтобы" in text_lower or "что бы" in text_lower)
 
     return is_valid
 
 async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE,
                              user_story: str, show_add_to_db: bool = False,
                              is_improved: bool = False, is_callback: bool = False,
-                             skip_similar_search: bool = False) -> None:
+                             skip_similar_search: bool = False, norm: Optional[str] = None) -> None:
     """Анализ User Story с улучшенным поиском похожих историй"""
     try:
         db = context.bot_data['db']
@@ -348,19 +364,70 @@ async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await update.message.reply_text(error_msg, reply_markup=navigation_keyboard())
             return
 
-        norm = normalize_text(user_story)
+        if norm is None:
+            norm = normalize_text(user_story)
         logger.info(f"Analyzing user story: {user_story[:100]}...")
 
+        # Повторный анализ той же истории берем из кэша без обращения к БД и LLM
+        cached_analysis = await _get_cached_analysis(context, user_story, norm)
+        if 'bot' in context.bot_data:
+            context.bot_data['bot'].stats['cache_hits' if cached_analysis else 'cache_misses'] += 1
+        if cached_analysis:
+            logger.info("Using cached analysis, skipping LLM")
+            # В кэше лежит готовый к показу анализ (уже с заголовком User Story)
+            analysis = cached_analysis['analysis']
+            keyboard = analysis_result_keyboard(
+                show_add_to_db=should_show_add_to_db_button(analysis, is_improved),
+                has_improvement_history='improvement_chain' in context.user_data,
+                analysis_text=analysis
+            )
+
+            response_text = safe_truncate_text(analysis)
+            if is_callback:
+                await update.callback_query.edit_message_text(
+                    response_text,
+                    reply_markup=keyboard,
+                    parse_mode='Markdown'
+                )
+            else:
+                await update.message.reply_text(
+                    response_text,
+                    reply_markup=keyboard,
+                    parse_mode='Markdown'
+                )
+
+            await _add_to_user_history(context, user_id, user_story, analysis)
+            context.user_data['last_analysis'] = {
+                'story': user_story,
+                'analysis': analysis,
+                'timestamp': datetime.now().isoformat()
+            }
+
+            # Улучшенная история, которую уже анализировали раньше, тоже попадает в golden
+            if is_improved and not cached_analysis.get('golden_added'):
+                try:
+                    score = extract_score_from_analysis(analysis)
+                    if score >= 4:
+                        await db.add_example(
+                            user_story, norm, analysis, is_golden=True, score=score
+                        )
+                        await _cache_analysis(context, user_story, {**cached_analysis, 'golden_added': True}, norm)
+                        logger.info(f"Added improved story to golden examples: {user_story[:50]}...")
+                except Exception as e:
+                    logger.error(f"Error adding cached improved story to golden: {e}")
+            return
+
         # Если не нужно пропускать поиск похожих (обычный сценарий)
         similar_high = []
         similar_medium = []
         similar_low = []
         
         if not skip_similar_search:
-            # Ищем похожие истории с разными порогами
-            similar_high = await db.find_similar(user_story, threshold=0.95)  # Очень похожие
-            similar_medium = await db.find_similar(user_story, threshold=0.75)  # Похожие
-            similar_low = await db.find_similar(user_story, threshold=0.60)  # Слабые совпадения
+            # Один запрос кандидатов к БД; каждый порог ранжируется так же, как отдельный
+            # поиск (повторные поиски отдает кэш результатов ExamplesDB)
+            similar_high, similar_medium, similar_low = await db.find_similar_multi(
+                user_story, (0.95, 0.75, 0.60)  # Очень похожие / Похожие / Слабые совпадения
+            )
 
             logger.info(f"Search results - High: {len(similar_high)}, Medium: {len(similar_medium)}, Low: {len(similar_low)}")
 
@@ -403,18 +470,18 @@ async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE
                     )
 
                 # Сохраняем в историю и кэш
-                _add_to_user_history(context, user_id, story, formatted_answer)
-                _cache_analysis(context, story, {
-                    'story': story,
-                    'analysis': formatted_answer,
-                    'timestamp': datetime.now().isoformat()
-                })
-
-                context.user_data['last_analysis'] = {
+                analysis_record = {
                     'story': story,
                     'analysis': formatted_answer,
                     'timestamp': datetime.now().isoformat()
                 }
+                await _add_to_user_history(context, user_id, story, formatted_answer)
+                # В кэш - в том же виде, что и анализ от LLM: с заголовком User Story
+                await _cache_analysis(context, story, {
+                    **analysis_record,
+                    'analysis': f"**User Story:**\n_{story}_\n\n{formatted_answer}"
+                })
+                context.user_data['last_analysis'] = analysis_record
                 return
 
             # Если есть несколько похожих историй (75%+), показываем их для выбора
@@ -449,7 +516,8 @@ async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE
             elif similar_low and not is_improved:
                 logger.info(f"Found {len(similar_low)} weak matches, offering improvement")
                 
-                keyboard = similar_stories_keyboard(similar_low[:2], user_story)
+                top_similar = similar_low[:2]
+                keyboard = similar_stories_keyboard(top_similar, user_story)
                 message_text = (
                     f"🔍 **Найдены частично похожие истории** (сходство от {similar_low[0][2]:.0%}):\n\n"
                     "Вы можете выбрать одну из них, улучшить вашу историю через ИИ или использовать свой вариант:"
@@ -466,7 +534,7 @@ async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE
                         reply_markup=keyboard
                     )
 
-                context.user_data['similar_stories'] = similar_low[:2]
+                context.user_data['similar_stories'] = top_similar
                 context.user_data['original'] = user_story
                 return
 
@@ -479,37 +547,25 @@ async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE
             analysis_msg = await update.message.reply_text("🔍 Анализирую историю...")
 
         try:
-            # Анализ через LLM
+            # Анализ через LLM: показываем ответ по мере генерации
             prompt = build_invest_prompt(user_story)
-            response = await llm_client.get_chat_completion(prompt)
-
-            # УЛУЧШЕННАЯ ОБРАБОТКА ОТВЕТА ОТ LLM
-            answer_text = ""
-            if isinstance(response, tuple) and len(response) >= 1:
-                answer_text = response[0]
-            elif isinstance(response, str):
-                answer_text = response
+            if is_callback:
+                edit_progress = update.callback_query.edit_message_text
             else:
-                # Если ответ не tuple и не str, преобразуем в строку
-                answer_text = str(response)
-            
-            # Дополнительная проверка и очистка
-            if not isinstance(answer_text, str):
-                logger.warning(f"Unexpected response type from LLM: {type(answer_text)}")
-                answer_text = str(answer_text)
-            
-            # Убираем возможные лишние символы
-            answer_text = answer_text.strip()
+                edit_progress = analysis_msg.edit_text
+            answer_text = await _stream_llm(llm_client, prompt, edit_progress)
 
             analysis = format_analysis_for_display(answer_text, user_story)
 
-            # Определяем, показывать ли кнопку добавления в базу
-            should_show_add_button = should_show_add_to_db_button(analysis, is_improved)
+            # Оценку извлекаем один раз: для кнопки добавления и для автодобавления в golden
+            score = extract_score_from_analysis(analysis)
+            should_show_add_button = should_show_add_to_db_button(analysis, is_improved, score=score)
 
             keyboard = analysis_result_keyboard(
                 show_add_to_db=should_show_add_button,
                 has_improvement_history='improvement_chain' in context.user_data,
-                analysis_text=analysis
+                analysis_text=analysis,
+                score=score
             )
 
             if is_callback:
@@ -526,25 +582,23 @@ async def _analyze_user_story(update: Update, context: ContextTypes.DEFAULT_TYPE
                 )
 
             # Сохраняем в историю и кэш
-            _add_to_user_history(context, user_id, user_story, analysis)
-            _cache_analysis(context, user_story, {
-                'story': user_story,
-                'analysis': analysis,
-                'timestamp': datetime.now().isoformat()
-            })
-
-            context.user_data['last_analysis'] = {
+            analysis_record = {
                 'story': user_story,
                 'analysis': analysis,
                 'timestamp': datetime.now().isoformat()
             }
+            await _add_to_user_history(context, user_id, user_story, analysis)
+            context.user_data['last_analysis'] = analysis_record
 
             # Автоматически добавляем улучшенные истории в golden
-            if is_improved and extract_score_from_analysis(analysis) >= 4:
+            if is_improved and score >= 4:
                 await db.add_example(
-                    user_story, norm, analysis, is_golden=True, score=extract_score_from_analysis(analysis)
+                    user_story, norm, analysis, is_golden=True, score=score
                 )
                 logger.info(f"Added improved story to golden examples: {user_story[:50]}...")
+                # Отметка в кэше: при повторном анализе из кэша не добавлять историю еще раз
+                analysis_record['golden_added'] = True
+            await _cache_analysis(context, user_story, analysis_record, norm)
 
         except Exception as e:
             logger.error(f"Error in LLM analysis: {e}")
@@ -638,18 +692,18 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
                 # Сохраняем в историю и кэш
                 user_id = update.effective_user.id
-                _add_to_user_history(context, user_id, story, formatted_answer)
-                _cache_analysis(context, story, {
-                    'story': story,
-                    'analysis': formatted_answer,
-                    'timestamp': datetime.now().isoformat()
-                })
-
-                context.user_data['last_analysis'] = {
+                analysis_record = {
                     'story': story,
                     'analysis': formatted_answer,
                     'timestamp': datetime.now().isoformat()
                 }
+                await _add_to_user_history(context, user_id, story, formatted_answer)
+                # В кэш - в том же виде, что и анализ от LLM: с заголовком User Story
+                await _cache_analysis(context, story, {
+                    **analysis_record,
+                    'analysis': f"**User Story:**\n_{story}_\n\n{formatted_answer}"
+                })
+                context.user_data['last_analysis'] = analysis_record
 
             else:
                 await query.edit_message_text(
@@ -668,8 +722,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 return
 
             prompt = build_fix_prompt(original)
-            response = await llm_client.get_chat_completion(prompt)
-            fixed = response[0].strip()
+            fixed = await _call_llm(llm_client, prompt)
 
             await query.edit_message_text(
                 f"✨ *Исправленная версия:*\n\n_{fixed}_\n\nХотите проанализировать исправленную версию?",
@@ -733,8 +786,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                     current_analysis = last_analysis.get('analysis')
 
                 prompt = build_improve_prompt(pending, current_analysis)
-                response = await llm_client.get_chat_completion(prompt)
-                improved = response[0].strip()
+                improved = await _call_llm(llm_client, prompt)
 
                 # Сохраняем улучшенную версию
                 context.user_data['improvement_chain'].add_version(improved, "Улучшенная версия - требует анализа")
@@ -747,14 +799,14 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 message_text = "🔄 *Цепочка улучшений*\n\n"
 
                 if initial:
-                    message_text += f"📝 *Исходная версия:*\n_{initial['story']}_\n\n"
-                    if 'analysis' in initial and initial['analysis']:
+                    message_text += f"📝 *Исходная версия:*\n_{initial.story}_\n\n"
+                    if initial.analysis:
                         # Извлекаем оценку из анализа
-                        score_match = re.search(r'Оценка:\s*(\d/6)', initial['analysis'])
+                        score_match = _SCORE_LABEL_RE.search(initial.analysis)
                         if score_match:
                             message_text += f"📊 **Исходная оценка:** {score_match.group(1)}\n\n"
 
-                message_text += f"🚀 *Улучшенная версия (v{latest['version']}):*\n_{latest['story']}_\n\n"
+                message_text += f"🚀 *Улучшенная версия (v{latest.version}):*\n_{latest.story}_\n\n"
                 message_text += "Хотите проанализировать улучшенную версию?"
 
                 await query.edit_message_text(
@@ -797,8 +849,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
             context.user_data['pending_text'] = current
             prompt = build_improve_prompt(current)
-            response = await llm_client.get_chat_completion(prompt)
-            improved = response[0].strip()
+            improved = await _call_llm(llm_client, prompt)
 
             # Сохраняем новую улучшенную версию в цепочку
             if 'improvement_chain' in context.user_data:
@@ -825,25 +876,25 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 )
                 return
 
-            message_text = "📋 *История улучшений User Story*\n\n"
+            parts = ["📋 *История улучшений User Story*\n\n"]
+            separator = "\n" + "═" * 40 + "\n\n"
 
             # Показываем ВСЕ версии, начиная с первой
             for version in chain.versions:
-                message_text += f"*Версия {version['version']}:*\n"
-                message_text += f"_{version['story']}_\n"
+                parts.append(f"*Версия {version.version}:*\n_{version.story}_\n")
 
-                if version.get('analysis') and version['analysis'] != "Улучшенная версия - требует анализа":
+                if version.analysis and version.analysis != "Улучшенная версия - требует анализа":
                     # Извлекаем оценку из анализа
-                    score_match = re.search(r'Оценка:\s*(\d/6)', version['analysis'])
+                    score_match = _SCORE_LABEL_RE.search(version.analysis)
                     if score_match:
-                        message_text += f"📊 **Оценка:** {score_match.group(1)}\n"
+                        parts.append(f"📊 **Оценка:** {score_match.group(1)}\n")
 
-                message_text += "\n" + "═" * 40 + "\n\n"
+                parts.append(separator)
 
-            message_text += "Вы можете улучшить историю еще раз или проанализировать последнюю версию."
+            parts.append("Вы можете улучшить историю еще раз или проанализировать последнюю версию.")
 
             # Обрезаем текст если слишком длинный
-            message_text = safe_truncate_text(message_text)
+            message_text = safe_truncate_text("".join(parts))
 
             await query.edit_message_text(
                 message_text,
@@ -865,14 +916,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             if 'timestamp' in last_analysis:
                 content += f"\n\nДата анализа: {last_analysis['timestamp']}"
 
-            bio = io.BytesIO(content.encode('utf-8'))
-            bio.name = 'analysis.txt'
-
             await query.message.reply_document(
-                document=InputFile(bio, filename='INVEST_analysis.txt'),
+                document=InputFile(content.encode('utf-8'), filename='INVEST_analysis.txt'),
                 caption="📄 Экспорт анализа в TXT"
             )
-            bio.close()
 
             # Возвращаемся к результатам анализа
             await query.edit_message_text(
@@ -894,19 +941,16 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 )
                 return
 
-            # Экранируем кавычки для CSV
-            story_escaped = last_analysis['story'].replace('"', '""')
-            analysis_escaped = last_analysis['analysis'].replace('"', '""')
-
-            content = f'"{story_escaped}";"{analysis_escaped}"'
-            bio = io.BytesIO(content.encode('utf-8'))
-            bio.name = 'analysis.csv'
-
+            # csv.writer сам экранирует кавычки и переносы строк
+            buffer = io.StringIO()
+            # Формат прежний: одна строка "история";"анализ" без заголовка и перевода строки
+            writer = csv.writer(buffer, delimiter=';', quoting=csv.QUOTE_ALL, lineterminator='')
+            writer.writerow([last_analysis['story'], last_analysis['analysis']])
+            content = buffer.getvalue()
             await query.message.reply_document(
-                document=InputFile(bio, filename='INVEST_analysis.csv'),
+                document=InputFile(content.encode('utf-8'), filename='INVEST_analysis.csv'),
                 caption="📊 Экспорт анализа в CSV"
             )
-            bio.close()
 
             # Возвращаемся к результатам анализа
             await query.edit_message_text(
@@ -929,14 +973,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 return
 
             content = f"Улучшенная User Story:\n{improved}\n\n✨ Сгенерировано INVEST-Checker"
-            bio = io.BytesIO(content.encode('utf-8'))
-            bio.name = 'improved_user_story.txt'
-
             await query.message.reply_document(
-                document=InputFile(bio, filename='improved_user_story.txt'),
+                document=InputFile(content.encode('utf-8'), filename='improved_user_story.txt'),
                 caption="🚀 Экспорт улучшенной истории"
             )
-            bio.close()
 
             # Возвращаемся к улучшенной истории
             await query.edit_message_text(
@@ -959,9 +999,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             story_to_add = last_analysis['story']
             chain = context.user_data.get('improvement_chain')
             if chain and chain.get_initial():
-                story_to_add = chain.get_initial()['story']  # Добавляем исходную версию
+                story_to_add = chain.get_initial().story  # Добавляем исходную версию
 
-            norm = normalize_text(story_to_add)
+            if story_to_add == context.user_data.get('initial_story'):
+                norm = context.user_data['initial_norm']
+            else:
+                norm = normalize_text(story_to_add)
             await db.add_example(
                 story_to_add, norm, last_analysis['analysis'], is_golden=False, score=0
             )
@@ -1083,16 +1126,17 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                     # Возврат к истории улучшений
                     chain = context.user_data.get('improvement_chain')
                     if chain and len(chain.versions) >= 2:
-                        message_text = "📋 **История улучшений User Story**\n\n"
-                        for i, version in enumerate(chain.versions):
-                            message_text += f"**Версия {version['version']}:**\n"
-                            message_text += f"_{version['story']}_\n"
-                            if 'analysis' in version and version['analysis']:
-                                score_match = re.search(r'Оценка:\s*(\d/6)', version['analysis'])
+                        parts = ["📋 **История улучшений User Story**\n\n"]
+                        separator = "\n" + "═" * 30 + "\n\n"
+                        for version in chain.versions:
+                            parts.append(f"**Версия {version.version}:**\n_{version.story}_\n")
+                            if version.analysis:
+                                score_match = _SCORE_LABEL_RE.search(version.analysis)
                                 if score_match:
-                                    message_text += f"📊 Оценка: {score_match.group(1)}\n"
-                            message_text += "\n" + "═" * 30 + "\n\n"
-                        message_text += "Вы можете улучшить историю еще раз или проанализировать последнюю версию."
+                                    parts.append(f"📊 Оценка: {score_match.group(1)}\n")
+                            parts.append(separator)
+                        parts.append("Вы можете улучшить историю еще раз или проанализировать последнюю версию.")
+                        message_text = "".join(parts)
 
                         await query.edit_message_text(
                             message_text,
@@ -1179,7 +1223,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         elif data == "restart":
             try:
                 # Очищаем только временные данные, сохраняем историю
-                keys_to_keep = ['initial_story', 'user_history', 'last_analysis']
+                keys_to_keep = ['initial_story', 'initial_norm', 'user_history', 'last_analysis']
                 temp_data = {}
                 for key in keys_to_keep:
                     if key in context.user_data:
@@ -1294,6 +1338,21 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         except Exception as edit_error:
             logger.error(f"Failed to edit message: {edit_error}")
 
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик ошибок, не перехваченных в обработчиках"""
+    logger.error("Unhandled error", exc_info=context.error)
+
+    if isinstance(update, Update) and update.effective_chat:
+        # Уведомление отправляем фоновой задачей - обработчик ошибок не ждет Bot API.
+        # Ошибка отправки вернется сюда же с update=None и будет только залогирована
+        context.application.create_task(
+            context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="❌ Произошла ошибка. Попробуйте снова.",
+                reply_markup=main_menu_keyboard()
+            )
+        )
+
 def register_handlers(app: Application) -> None:
     """Регистрация всех обработчиков"""
     app.add_handler(CommandHandler("start", start))
@@ -1301,6 +1360,7 @@ def register_handlers(app: Application) -> None:
     app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CallbackQueryHandler(callback_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_error_handler(error_handler)
 
 async def show_database(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     """Показать базу историй с пагинацией"""
@@ -1314,8 +1374,18 @@ async def show_database(update: Update, context: ContextTypes.DEFAULT_TYPE, page
         db = context.bot_data['db']
         page_size = 5  # Показываем по 5 историй на странице
 
-        # Получаем истории для текущей страницы
-        stories = await db.get_all_stories(page, page_size)
+        # Получаем истории для текущей страницы; ключ последней истории предыдущей
+        # страницы (если уже известен) позволяет БД не пропускать строки через OFFSET.
+        # Курсоры годны только в рамках одного просмотра и пока в базу не было записей:
+        # иначе страницы сдвинутся и строки пропадут или повторятся
+        cursors = context.user_data.get('db_page_cursors')
+        if page == 0 or cursors is None or context.user_data.get('db_page_cursors_version') != db.stories_version:
+            cursors = context.user_data['db_page_cursors'] = {}
+            context.user_data['db_page_cursors_version'] = db.stories_version
+        stories = await db.get_all_stories(page, page_size, after=cursors.get(page))
+        if stories:
+            last = stories[-1]
+            cursors[page + 1] = (last['created_at'], last['score'], last['id'])
         total_stories = await db.get_total_stories_count()
         total_pages = (total_stories + page_size - 1) // page_size if total_stories > 0 else 1
 
@@ -1330,8 +1400,7 @@ async def show_database(update: Update, context: ContextTypes.DEFAULT_TYPE, page
             return
 
         # Информация о странице в тексте сообщения
-        message_text = "📁 *База User Stories*\n\n"
-        message_text += f"📄 *Страница {page+1}/{total_pages}* | Всего историй: {total_stories}\n\n"
+        parts = [f"📁 *База User Stories*\n\n📄 *Страница {page+1}/{total_pages}* | Всего историй: {total_stories}\n\n"]
 
         for i, story in enumerate(stories):
             story_number = page * page_size + i + 1
@@ -1350,9 +1419,10 @@ async def show_database(update: Update, context: ContextTypes.DEFAULT_TYPE, page
             elif score >= 4:
                 quality_emoji = "✅"
 
-            message_text += f"{quality_emoji} **{story_number}. [{score}/6]** {story_text}\n\n"
+            parts.append(f"{quality_emoji} **{story_number}. [{score}/6]** {story_text}\n\n")
 
-        message_text += "_Используйте кнопки ниже для навигации_"
+        parts.append("_Используйте кнопки ниже для навигации_")
+        message_text = "".join(parts)
 
         # Определяем наличие предыдущих/следующих страниц
         has_previous = page > 0
@@ -1388,18 +1458,22 @@ async def show_story_details(update: Update, context: ContextTypes.DEFAULT_TYPE,
             return
 
         # Форматируем детальное отображение истории
-        message_text = "📖 **Детали User Story**\n\n"
-        message_text += f"**ID:** {story['id']}\n"
-        message_text += f"**Оценка:** {story.get('score', 'N/A')}/6\n"
-        message_text += f"**Статус:** {'⭐ Золотая история' if story.get('is_golden') else '📝 Обычная история'}\n"
-        message_text += f"**Дата добавления:** {story.get('created_at', 'N/A')}\n\n"
-
-        message_text += f"**User Story:**\n_{story['query']}_\n\n"
+        status = '⭐ Золотая история' if story.get('is_golden') else '📝 Обычная история'
+        parts = [
+            "📖 **Детали User Story**\n\n"
+            f"**ID:** {story['id']}\n"
+            f"**Оценка:** {story.get('score', 'N/A')}/6\n"
+            f"**Статус:** {status}\n"
+            f"**Дата добавления:** {story.get('created_at', 'N/A')}\n\n"
+            f"**User Story:**\n_{story['query']}_\n\n"
+        ]
 
         if story.get('answer'):
             # Форматируем анализ для лучшего отображения
             analysis = format_analysis_for_display(story['answer'], story['query'])
-            message_text += f"**Анализ INVEST:**\n{analysis}"
+            parts.append(f"**Анализ INVEST:**\n{analysis}")
+
+        message_text = "".join(parts)
 
         current_page = context.user_data.get('current_db_page', 0)
 
@@ -1418,11 +1492,59 @@ async def show_story_details(update: Update, context: ContextTypes.DEFAULT_TYPE,
             reply_markup=database_keyboard(0, 1, False, False)
         )
 
-def _add_to_user_history(context: ContextTypes.DEFAULT_TYPE, user_id: int, story: str, analysis: str = None):
+async def _call_llm(llm_client, messages: list) -> str:
+    """Запрос к LLM напрямую через асинхронный клиент (без пула потоков)"""
+    answer = await llm_client.chat(messages)
+    if not isinstance(answer, str):
+        logger.warning(f"Unexpected response type from LLM: {type(answer)}")
+        answer = str(answer)
+    return answer.strip()
+
+async def _edit_progress_quietly(edit_progress, text: str) -> None:
+    """Промежуточное обновление сообщения: оно косметическое, ошибки только логируем"""
+    try:
+        await edit_progress(text)
+    except TelegramError as e:
+        # RetryAfter, TimedOut, ... не должны прерывать анализ
+        logger.debug(f"Skipping progress update: {e}")
+
+async def _stream_llm(llm_client, messages: list, edit_progress) -> str:
+    """Потоковый запрос к LLM с периодическим обновлением сообщения частичным ответом"""
+    parts = []
+    last_edit = time.monotonic()
+    edit_task = None
+    try:
+        # aclosing: при выходе из цикла поток сразу закрывается и освобождает
+        # слот семафора LLM и HTTP-соединение, не дожидаясь сборщика мусора
+        async with aclosing(llm_client.chat_stream(messages)) as stream:
+            async for chunk in stream:
+                parts.append(chunk)
+                now = time.monotonic()
+                # Пока поток открыт, он держит слот семафора LLM: правку сообщения не ждем,
+                # а запускаем отдельно и пропускаем новые, пока предыдущая не завершилась
+                if now - last_edit >= _STREAM_EDIT_INTERVAL and (edit_task is None or edit_task.done()):
+                    last_edit = now
+                    edit_task = asyncio.create_task(_edit_progress_quietly(
+                        edit_progress, safe_truncate_text("🔍 Анализирую историю...\n\n" + "".join(parts))
+                    ))
+    except Exception as e:
+        if parts:
+            raise
+        # Поток не начался - повторяем обычным запросом (с retry логикой клиента)
+        logger.warning(f"LLM streaming failed, falling back to regular request: {e}")
+        return await _call_llm(llm_client, messages)
+    finally:
+        # Дожидаемся последней правки уже без слота LLM, чтобы она не легла поверх итогового ответа
+        if edit_task is not None:
+            await edit_task
+
+    return "".join(parts).strip()
+
+async def _add_to_user_history(context: ContextTypes.DEFAULT_TYPE, user_id: int, story: str, analysis: str = None):
     """Добавить запись в историю пользователя"""
     # Пробуем использовать объект бота из bot_data
     if 'bot' in context.bot_data and hasattr(context.bot_data['bot'], 'add_to_user_history'):
-        context.bot_data['bot'].add_to_user_history(user_id, story, analysis)
+        await context.bot_data['bot'].add_to_user_history(user_id, story, analysis)
         return
     
     # Fallback: сохраняем в context.bot_data
@@ -1430,32 +1552,51 @@ def _add_to_user_history(context: ContextTypes.DEFAULT_TYPE, user_id: int, story
         context.bot_data['user_history'] = {}
     
     if user_id not in context.bot_data['user_history']:
-        context.bot_data['user_history'][user_id] = []
+        context.bot_data['user_history'][user_id] = deque(maxlen=_MAX_HISTORY_DEPTH)
         # Обновляем статистику сессий
         if 'stats' in context.bot_data:
             context.bot_data['stats']['user_sessions'] += 1
 
-    history_entry = {
-        'timestamp': datetime.now().isoformat(),
-        'story': story,
-        'analysis': analysis,
-        'type': 'user_story'
-    }
-
-    context.bot_data['user_history'][user_id].append(history_entry)
+    context.bot_data['user_history'][user_id].append(HistoryEntry(time.time(), story, analysis))
     
     # Обновляем статистику сообщений
     if 'stats' in context.bot_data:
         context.bot_data['stats']['total_messages'] += 1
 
-    # Ограничиваем глубину истории для экономии памяти
-    max_history_depth = 50
-    if len(context.bot_data['user_history'][user_id]) > max_history_depth:
-        context.bot_data['user_history'][user_id] = context.bot_data['user_history'][user_id][-max_history_depth:]
+def _analysis_cache_key(story: str, norm: Optional[str] = None) -> str:
+    """Ключ кэша анализа: хэш нормализованного текста (одинаков во всех процессах)"""
+    if norm is None:
+        norm = normalize_text(story)
+    digest = hashlib.blake2b(norm.encode('utf-8'), digest_size=16).hexdigest()
+    return f"analysis_{digest}"
+
+async def _get_cached_analysis(context: ContextTypes.DEFAULT_TYPE, story: str, norm: Optional[str] = None):
+    """Получить анализ из кэша (память процесса, затем Redis)"""
+    cache_key = _analysis_cache_key(story, norm)
+    cached = context.bot_data.get('analysis_cache', {}).get(cache_key)
+    if cached is not None:
+        return cached
+
+    storage = getattr(context.bot_data.get('bot'), 'storage', None)
+    if storage:
+        try:
+            return await storage.get_analysis(cache_key)
+        except Exception as e:
+            logger.error(f"Error reading analysis from Redis: {e}")
+    return None
 
-def _cache_analysis(context: ContextTypes.DEFAULT_TYPE, story: str, analysis_data: dict):
+async def _cache_analysis(context: ContextTypes.DEFAULT_TYPE, story: str, analysis_data: dict,
+                          norm: Optional[str] = None):
     """Сохранить анализ в кэш"""
-    cache_key = f"analysis_{hash(story.lower().strip())}"
+    cache_key = _analysis_cache_key(story, norm)
+
+    storage = getattr(context.bot_data.get('bot'), 'storage', None)
+    if storage:
+        try:
+            await storage.set_analysis(cache_key, analysis_data)
+        except Exception as e:
+            logger.error(f"Error writing analysis to Redis: {e}")
+
     if 'analysis_cache' not in context.bot_data:
         context.bot_data['analysis_cache'] = {}
     
@@ -1,6 +1,11 @@
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from utils import extract_score_from_analysis
 
+# InlineKeyboardMarkup неизменяем, поэтому статические клавиатуры строим один раз
+# и переиспользуем (кэш по аргументам)
+
+@lru_cache(maxsize=None)
 def main_menu_keyboard() -> InlineKeyboardMarkup:
     """Главное меню с новой кнопкой База US"""
     keyboard = [
@@ -12,6 +17,7 @@ def main_menu_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=32)
 def help_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("🔍 Начать анализ", callback_data="analyze_invest")],
@@ -22,6 +28,7 @@ def help_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=32)
 def navigation_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     keyboard = []
     if previous_state and previous_state != "main_menu":
@@ -53,13 +60,23 @@ def similar_stories_keyboard(similar_stories: list, original_text: str) -> Inlin
 
 
 def analysis_result_keyboard(show_add_to_db: bool = False, previous_state: str = None,
-                           has_improvement_history: bool = False, analysis_text: str = None) -> InlineKeyboardMarkup:
+                           has_improvement_history: bool = False, analysis_text: str = None,
+                           score: int = None) -> InlineKeyboardMarkup:
     """
-    Улучшенная клавиатура с правильной логикой показа кнопки добавления в базу
+    Улучшенная клавиатура с правильной логикой показа кнопки добавления в базу.
+    Уже извлеченную оценку можно передать в score, чтобы не разбирать анализ повторно.
     """
-    if previous_state == "main_menu":
-        previous_state = None
+    # Показываем кнопку только для историй с оценкой 5/6 или 6/6
+    if show_add_to_db and analysis_text and score is None:
+        score = extract_score_from_analysis(analysis_text)
+    show_add_button = bool(show_add_to_db and analysis_text and score >= 5)
+    has_back = bool(previous_state and previous_state != "main_menu")
+    return _analysis_result_keyboard(show_add_button, has_back, has_improvement_history)
+
 
+@lru_cache(maxsize=None)
+def _analysis_result_keyboard(show_add_button: bool, has_back: bool,
+                              has_improvement_history: bool) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("🚀 Улучшить историю", callback_data="improve_story")],
     ]
@@ -72,20 +89,18 @@ def analysis_result_keyboard(show_add_to_db: bool = False, previous_state: str =
     keyboard.append([InlineKeyboardButton("📤 Экспорт", callback_data="export")])
 
     # кнопки "Добавить в базу"
-    if show_add_to_db and analysis_text:
-        score = extract_score_from_analysis(analysis_text)
-        # Показываем кнопку только для историй с оценкой 5/6 или 6/6
-        if score >= 5:
-            keyboard.insert(0, [InlineKeyboardButton("💾 Добавить в базу", callback_data="add_to_db")])
+    if show_add_button:
+        keyboard.insert(0, [InlineKeyboardButton("💾 Добавить в базу", callback_data="add_to_db")])
 
     # Навигационные кнопки
-    if previous_state and previous_state != "main_menu":
+    if has_back:
         keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back")])
     keyboard.append([InlineKeyboardButton("🔄 В начало", callback_data="restart")])
 
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=32)
 def improved_story_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("🔍 Проанализировать улучшенную", callback_data="analyze_improved")],
@@ -100,6 +115,7 @@ def improved_story_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=32)
 def improvement_history_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton("🔄 Улучшить еще раз", callback_data="improve_again")],
@@ -113,6 +129,7 @@ def improvement_history_keyboard(previous_state: str = None) -> InlineKeyboardMa
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=32)
 def export_menu_keyboard(previous_state: str = None) -> InlineKeyboardMarkup:
     keyboard = [
         [
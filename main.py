@@ -1,10 +1,14 @@
 import logging
-import asyncio
+import os
+import time
+import orjson
 
-from datetime import datetime
+from collections import deque
+from datetime import timedelta
 from dotenv import load_dotenv
 from telegram.ext import Application
 from config import Config
+from bot import ChatOrderedUpdateProcessor, HistoryEntry, RedisStorage
 from gigachat_client import GigaChatClient
 from db import ExamplesDB
 from handlers import register_handlers
@@ -34,11 +38,77 @@ async def initialize_components():
     
     return db, llm_client
 
+def load_analysis_cache(path: str) -> dict:
+    """Загрузить кэш анализов, сохраненный при прошлой остановке"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            cache = orjson.loads(f.read())
+        logging.info(f"Loaded {len(cache)} cached analyses from {path}")
+        return cache
+    except Exception as e:
+        logging.warning(f"Failed to load analysis cache: {e}")
+        return {}
+
+def save_analysis_cache(path: str, cache: dict) -> None:
+    """Сохранить кэш анализов на диск (ключи - blake2b, одинаковы между запусками)"""
+    if not path or not cache:
+        return
+    # Пишем во временный файл рядом и подменяем атомарно: падение посреди записи
+    # не оставит обрезанный JSON вместо прошлого кэша
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(cache))
+        os.replace(tmp_path, path)
+        logging.info(f"Saved {len(cache)} cached analyses to {path}")
+    except Exception as e:
+        logging.warning(f"Failed to save analysis cache: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+async def post_init(app: Application) -> None:
+    """Инициализация компонентов в event loop самого Application"""
+    db, llm_client = await initialize_components()
+    app.bot_data.update({
+        'db': db,
+        'llm_client': llm_client,
+        'analysis_cache': load_analysis_cache(Config.ANALYSIS_CACHE_PATH)
+    })
+
+async def post_shutdown(app: Application) -> None:
+    """Сохранение состояния при остановке бота"""
+    save_analysis_cache(Config.ANALYSIS_CACHE_PATH, app.bot_data.get('analysis_cache'))
+
+    bot = app.bot_data.get('bot')
+    db = app.bot_data.get('db')
+    llm_client = app.bot_data.get('llm_client')
+    if bot and db and llm_client:
+        stats = await bot.get_bot_stats(db, llm_client)
+        logging.info(f"Final stats: {orjson.dumps(stats, option=orjson.OPT_INDENT_2).decode()}")
+
+    # Все ресурсы закрываются здесь же, в event loop Application - без отдельных loop'ов
+    for resource in (db, llm_client, bot.storage if bot else None):
+        if resource is not None:
+            try:
+                await resource.close()
+            except Exception as e:
+                logging.error(f"Error closing {type(resource).__name__}: {e}")
+
 class SimpleBot:
     """Простой класс бота для хранения состояния с работающей статистикой"""
-    def __init__(self):
-        self.start_time = datetime.now()
+    DB_STATS_TTL = 15  # секунд между запросами статистики к БД
+
+    def __init__(self, storage: RedisStorage = None):
+        self.start_time = time.monotonic()  # не зависит от перевода системных часов
+        self.storage = storage  # Redis, если настроен; иначе история хранится в памяти
         self.user_history = {}
+        self.max_history_depth = 50  # Ограничиваем глубину истории для экономии памяти
+        # Кэш статистики БД для /stats: (время запроса, данные)
+        self._db_stats_cache = (0.0, None)
         self.stats = {
             'total_messages': 0,
             'user_sessions': 0,
@@ -46,41 +116,50 @@ class SimpleBot:
             'cache_misses': 0
         }
 
-    def add_to_user_history(self, user_id: int, story: str, analysis: str = None):
+    async def add_to_user_history(self, user_id: int, story: str, analysis: str = None):
         """Добавить запись в историю пользователя"""
+        history_entry = HistoryEntry(time.time(), story, analysis)
+        self.stats['total_messages'] += 1
+
+        if self.storage:
+            try:
+                if await self.storage.add_to_user_history(user_id, history_entry):
+                    self.stats['user_sessions'] += 1
+                return
+            except Exception as e:
+                logging.error(f"Redis history error, falling back to memory: {e}")
+
         if user_id not in self.user_history:
-            self.user_history[user_id] = []
+            # deque с maxlen сам вытесняет старые записи за O(1)
+            self.user_history[user_id] = deque(maxlen=self.max_history_depth)
             self.stats['user_sessions'] += 1
 
-        history_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'story': story,
-            'analysis': analysis,
-            'type': 'user_story'
-        }
-
         self.user_history[user_id].append(history_entry)
-        self.stats['total_messages'] += 1
-
-        # Ограничиваем глубину истории для экономии памяти
-        max_history_depth = 50
-        if len(self.user_history[user_id]) > max_history_depth:
-            self.user_history[user_id] = self.user_history[user_id][-max_history_depth:]
 
     async def get_bot_stats(self, db, llm_client):
         """Получить статистику бота"""
         try:
-            # Статистика базы данных
-            db_stats = await db.get_statistics()
+            # Статистика базы данных (кэшируется на DB_STATS_TTL секунд)
+            fetched_at, db_stats = self._db_stats_cache
+            if db_stats is None or time.monotonic() - fetched_at >= self.DB_STATS_TTL:
+                db_stats = await db.get_statistics()
+                self._db_stats_cache = (time.monotonic(), db_stats)
             
             # Статистика LLM клиента
             llm_stats = llm_client.get_stats()
             
             # Время работы
-            uptime = datetime.now() - self.start_time
+            uptime = timedelta(seconds=int(time.monotonic() - self.start_time))
             
             # Активные пользователи
-            active_users = len(self.user_history)
+            active_users = None
+            if self.storage:
+                try:
+                    active_users = await self.storage.count_users()
+                except Exception as e:
+                    logging.error(f"Redis stats error, falling back to memory: {e}")
+            if active_users is None:
+                active_users = len(self.user_history)
             
             # Расчет эффективности кэширования
             total_cache_requests = self.stats['cache_hits'] + self.stats['cache_misses']
@@ -119,23 +198,30 @@ def main():
         raise ValueError("TELEGRAM_TOKEN не найден в .env")
 
     try:
-        # Инициализируем компоненты
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        db, llm_client = loop.run_until_complete(initialize_components())
-        
         # Создаем простой объект бота
-        bot = SimpleBot()
+        storage = None
+        if Config.REDIS_URL:
+            storage = RedisStorage(Config.REDIS_URL, history_ttl=Config.USER_HISTORY_TTL)
+            logging.info("User history is stored in Redis")
+        bot = SimpleBot(storage)
         
-        # Создаем Application
-        app = Application.builder().token(token).build()
+        # Создаем Application с пулом соединений под параллельные ответы пользователям
+        app = (
+            Application.builder()
+            .token(token)
+            .connection_pool_size(Config.TELEGRAM_POOL_SIZE)
+            .pool_timeout(Config.TELEGRAM_TIMEOUT)
+            .read_timeout(Config.TELEGRAM_TIMEOUT)
+            .write_timeout(Config.TELEGRAM_TIMEOUT)
+            .get_updates_pool_timeout(5)
+            .concurrent_updates(ChatOrderedUpdateProcessor(Config.MAX_CONCURRENT_UPDATES))
+            .post_init(post_init)  # БД и LLM клиент создаются в том же loop, что и polling
+            .post_shutdown(post_shutdown)
+            .build()
+        )
         
-        # Добавляем в bot_data
-        app.bot_data.update({
-            'db': db,
-            'llm_client': llm_client,
-            'bot': bot  # Добавляем объект бота
-        })
+        # Добавляем в bot_data (db и llm_client добавит post_init)
+        app.bot_data['bot'] = bot
         
         # Регистрируем обработчики
         register_handlers(app)
@@ -1,7 +1,94 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 import re
 from functools import lru_cache
 
+# Экранирование спецсимволов Markdown: таблица для str.translate (один проход на C)
+_MARKDOWN_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '_*[]()~`>#+-=|{}.!'})
+
+# Регулярные выражения для очистки анализа (компилируются один раз)
+_EXTRA_NEWLINES_RE = re.compile(r'\n{3,}')
+
+# Частые опечатки: словарь замен и одно регулярное выражение на все варианты
+_COMMON_TYPOS = {
+    'чтлбы': 'чтобы', 'что бы': 'чтобы', 'чотбы': 'чтобы',
+    'востановить': 'восстановить',
+    'зарегестрироваться': 'зарегистрироваться', 'пользаватель': 'пользователь'
+}
+_TYPOS_RE = re.compile('|'.join(map(re.escape, _COMMON_TYPOS)))
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+
+# Оценка вида "Оценка: X/6" и запасной вариант "X/6"
+_SCORE_RE = re.compile(r"Оценка:\s*(\d)/6", re.IGNORECASE)
+_SCORE_FALLBACK_RE = re.compile(r"(\d)/6")
+_STORY_STRUCTURE_RE = re.compile(r"как\s+.+?,\s*я\s+хочу\s+.+?,\s*чтобы\s+.+?")
+
+# Лимит длины отформатированного анализа (с запасом до 4096 символов Telegram)
+_DISPLAY_LIMIT = 4000
+
+# Разметка строк анализа (константы уровня модуля, не пересоздаются на каждую строку)
+# Невыполненные критерии ("N: ✗", "N (Negotiable): ✗", "Negotiable: ✗") - одна регулярка на все
+_FAILED_CRITERIA_RE = re.compile(
+    r'(?P<N>N(?: \(Negotiable\))?: ✗|Negotiable: ✗)'
+    r'|(?P<E>E(?: \(Estimable\))?: ✗|Estimable: ✗)'
+    r'|(?P<I>I(?: \(Independent\))?: ✗|Independent: ✗)'
+    r'|(?P<T>T(?: \(Testable\))?: ✗|Testable: ✗)'
+)
+_PROBLEM_DESCRIPTIONS = (
+    ('N', "нет обсуждаемости"),
+    ('E', "сложно оценить"),
+    ('I', "зависит от других"),
+    ('T', "нет критериев тестирования"),
+)
+
+_SECTION_PREFIXES = ('Проблемы:', 'Рекомендации:')
+_BULLET_CHARS = frozenset('•-')  # маркер списка - всегда один первый символ
+_INVEST_CRITERIA_RE = re.compile(
+    r'I \(Independent\)|N \(Negotiable\)|V \(Valuable\)|E \(Estimable\)|S \(Small\)|T \(Testable\)'
+)
+
+
+# Системные промпты неизменны - собираются один раз при импорте, а не на каждый запрос
+_INVEST_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "Анализируй User Story по INVEST. Формат ответа:\n"
+        "Оценка: X/6\n"
+        "Проблемы: [только невыполненные критерии с кратким объяснением]\n"
+        "Рекомендации: [1-2 конкретных совета]\n\n"
+        "Пример:\n"
+        "Оценка: 4/6\n"
+        "Проблемы: N - нет обсуждаемости, E - сложно оценить\n"
+        "Рекомендации: Добавить варианты реализации, уточнить детали"
+    ),
+}
+
+_FIX_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "Исправь User Story, сохранив цель. Сделай ее:\n"
+        "- Более четкой и конкретной\n"
+        "- Соответствующей критериям INVEST\n"
+        "- С ясными критериями приемки\n"
+        "Верни только исправленную версию."
+    ),
+}
+
+_IMPROVE_SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "УЛУЧШИ User Story, сохранив цель и ценность.\n\n"
+        "Что улучшать:\n"
+        "1. Конкретные критерии приемки\n"
+        "2. Ясность формулировок\n"
+        "3. Обсуждаемость (Negotiable)\n\n"
+        "ЗАПРЕЩЕНО:\n"
+        "- Убирать существующие критерии приемки\n"
+        "- Делать историю менее конкретной\n"
+        "- Ухудшать тестируемость\n\n"
+        "Формат: [Улучшенная User Story с критериями приемки]"
+    ),
+}
+
 
 @lru_cache(maxsize=1000)
 def normalize_text(text: str) -> str:
@@ -13,78 +100,40 @@ def normalize_text(text: str) -> str:
         return ""
 
     # Приводим к нижнему регистру
-    text = text.lower().strip()
-
-    # Исправляем частые опечатки (быстрая версия)
-    common_typos = {
-        'чтлбы': 'чтобы', 'что бы': 'чтобы', 'чотбы': 'чтобы',
-        'востановить': 'восстановить', 'аккаунт': 'аккаунт',
-        'зарегестрироваться': 'зарегистрироваться', 'пользаватель': 'пользователь'
-    }
+    text = text.lower()
 
-    for typo, correct in common_typos.items():
-        text = text.replace(typo, correct)
+    # Исправляем частые опечатки за один проход
+    text = _TYPOS_RE.sub(lambda m: _COMMON_TYPOS[m.group(0)], text)
 
     # Упрощенная очистка - удаляем только действительно мешающие символы
-    text = re.sub(r'[^\w\s]', ' ', text)
-    text = re.sub(r'\s+', ' ', text)
+    text = _NON_WORD_RE.sub(' ', text)
 
-    return text.strip()
+    # Схлопываем пробелы и обрезаем края без дополнительного regex-прохода
+    return ' '.join(text.split())
 
 def build_invest_prompt(user_story: str) -> List[Dict[str, str]]:
     """
     Оптимизированный промпт для анализа INVEST.
     Сокращен на ~50% по сравнению с оригиналом.
     """
-    system_prompt = {
-        "role": "system",
-        "content": (
-            "Анализируй User Story по INVEST. Формат ответа:\n"
-            "Оценка: X/6\n"
-            "Проблемы: [только невыполненные критерии с кратким объяснением]\n"
-            "Рекомендации: [1-2 конкретных совета]\n\n"
-            "Пример:\n"
-            "Оценка: 4/6\n"
-            "Проблемы: N - нет обсуждаемости, E - сложно оценить\n"
-            "Рекомендации: Добавить варианты реализации, уточнить детали"
-        ),
-    }
-
     user_message = {"role": "user", "content": f"User Story: {user_story}"}
-    return [system_prompt, user_message]
+    return [_INVEST_SYSTEM_PROMPT, user_message]
 
 def build_fix_prompt(user_story: str) -> List[Dict[str, str]]:
     """
     Оптимизированный промпт для исправления User Story.
     """
-    system_prompt = {
-        "role": "system",
-        "content": (
-            "Исправь User Story, сохранив цель. Сделай ее:\n"
-            "- Более четкой и конкретной\n"
-            "- Соответствующей критериям INVEST\n"
-            "- С ясными критериями приемки\n"
-            "Верни только исправленную версию."
-        ),
-    }
-
     user_message = {"role": "user", "content": f"Исправь: {user_story}"}
-    return [system_prompt, user_message]
+    return [_FIX_SYSTEM_PROMPT, user_message]
 
 def _extract_problems(analysis: str) -> str:
     """Извлекает только проблемы из анализа для экономии токенов"""
     if not analysis:
         return "нет критических проблем"
 
-    problems = []
-    if "N: ✗" in analysis or "N (Negotiable): ✗" in analysis or "Negotiable: ✗" in analysis:
-        problems.append("нет обсуждаемости")
-    if "E: ✗" in analysis or "E (Estimable): ✗" in analysis or "Estimable: ✗" in analysis:
-        problems.append("сложно оценить")
-    if "I: ✗" in analysis or "I (Independent): ✗" in analysis or "Independent: ✗" in analysis:
-        problems.append("зависит от других")
-    if "T: ✗" in analysis or "T (Testable): ✗" in analysis or "Testable: ✗" in analysis:
-        problems.append("нет критериев тестирования")
+    # Один проход по тексту вместо двенадцати поисков подстрок
+    failed = {match.lastgroup for match in _FAILED_CRITERIA_RE.finditer(analysis)}
+    problems = [description for criterion, description in _PROBLEM_DESCRIPTIONS if criterion in failed]
 
     return ", ".join(problems) if problems else "нет критических проблем"
 
@@ -93,22 +142,6 @@ def build_improve_prompt(user_story: str, current_analysis: str = None) -> List[
     Умный промпт для улучшения User Story с сохранением качества.
     Оптимизированная версия - на 40% короче.
     """
-    system_prompt = {
-        "role": "system",
-        "content": (
-            "УЛУЧШИ User Story, сохранив цель и ценность.\n\n"
-            "Что улучшать:\n"
-            "1. Конкретные критерии приемки\n"
-            "2. Ясность формулировок\n"
-            "3. Обсуждаемость (Negotiable)\n\n"
-            "ЗАПРЕЩЕНО:\n"
-            "- Убирать существующие критерии приемки\n"
-            "- Делать историю менее конкретной\n"
-            "- Ухудшать тестируемость\n\n"
-            "Формат: [Улучшенная User Story с критериями приемки]"
-        ),
-    }
-
     user_content = f"Улучши: {user_story}"
 
     if current_analysis:
@@ -117,7 +150,7 @@ def build_improve_prompt(user_story: str, current_analysis: str = None) -> List[
             user_content += f"\nУчти проблемы: {problems}"
 
     user_message = {"role": "user", "content": user_content}
-    return [system_prompt, user_message]
+    return [_IMPROVE_SYSTEM_PROMPT, user_message]
 
 def extract_score_from_analysis(analysis_text: str) -> int:
     """
@@ -126,23 +159,11 @@ def extract_score_from_analysis(analysis_text: str) -> int:
     if not analysis_text:
         return -1
 
-    # Ищем паттерн оценки X/6
-    score_match = re.search(r"Оценка:\s*(\d)/6", analysis_text, re.IGNORECASE)
-    if score_match:
-        try:
-            return int(score_match.group(1))
-        except (ValueError, IndexError):
-            pass
-
-    # Альтернативный паттерн
-    score_match = re.search(r"(\d)/6", analysis_text)
-    if score_match:
-        try:
-            return int(score_match.group(1))
-        except (ValueError, IndexError):
-            pass
+    # Ищем паттерн оценки X/6, затем альтернативный паттерн
+    score_match = _SCORE_RE.search(analysis_text) or _SCORE_FALLBACK_RE.search(analysis_text)
 
-    return -1
+    # Группа (\d) - ровно одна цифра, int() не может упасть
+    return int(score_match.group(1)) if score_match else -1
 
 def is_high_quality_story(
     story: str, min_length: int = 10, max_length: int = 500
@@ -160,7 +181,7 @@ def is_high_quality_story(
         return False
 
     # Проверка базовой структуры
-    if not re.search(r"как\s+.+?,\s*я\s+хочу\s+.+?,\s*чтобы\s+.+?", story.lower()):
+    if not _STORY_STRUCTURE_RE.search(story.lower()):
         return False
 
     return True
@@ -187,10 +208,10 @@ def truncate_text(text: str, max_length: int = 4000) -> str:
 def clean_markdown(text: str) -> str:
     """Очистка проблемных символов Markdown"""
     # Экранируем проблемные последовательности
-    text = re.sub(r'([_*[\]()~`>#+\-=|{}.!])', r'\\\1', text)
+    text = text.translate(_MARKDOWN_ESCAPE_TABLE)
 
     # Убираем множественные переносы строк
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = _EXTRA_NEWLINES_RE.sub('\n\n', text)
 
     return text
 
@@ -217,9 +238,12 @@ def safe_truncate_text(text: str, max_length: int = 4000) -> str:
     else:
         return truncated.strip() + "\n\n... (текст обрезан)"
 
+@lru_cache(maxsize=256)
 def format_analysis_for_display(analysis: str, user_story: str = None) -> str:
     """
     Форматирование анализа для красивого отображения.
+    Результат кэшируется: одни и те же анализ и история форматируются повторно
+    при возврате к результатам и просмотре базы.
     """
     if not analysis:
         return "❌ Не удалось проанализировать историю"
@@ -227,11 +251,20 @@ def format_analysis_for_display(analysis: str, user_story: str = None) -> str:
     # Очищаем от проблемных символов
     analysis = clean_markdown(analysis.strip())
 
-    # Базовое форматирование
-    lines = analysis.split('\n')
+    # Добавляем User Story только если предоставлена и не пустая
+    header = f"**User Story:**\n_{user_story}_\n\n" if user_story and user_story.strip() else ""
+
+    # Базовое форматирование за один проход по строкам. Все, что дальше лимита
+    # сообщения, safe_truncate_text все равно отрежет - прекращаем набор строк,
+    # как только текст гарантированно длиннее лимита
     formatted_lines = []
+    budget = _DISPLAY_LIMIT - len(header)
+    total_len = -1  # первая строка без разделителя '\n'
+
+    for line in analysis.split('\n'):
+        if total_len > budget:
+            break
 
-    for line in lines:
         line = line.strip()
         if not line:
             continue
@@ -239,39 +272,37 @@ def format_analysis_for_display(analysis: str, user_story: str = None) -> str:
         # Форматируем заголовки
         if line.startswith('Оценка:'):
             formatted_lines.append(f"**{line}**")
-        elif line.startswith('Проблемы:') or line.startswith('Рекомендации:'):
+        elif line.startswith(_SECTION_PREFIXES):
             formatted_lines.append(f"\n**{line}**")
-        elif line.startswith('•') or line.startswith('-'):
+        elif line[0] in _BULLET_CHARS:
             # Форматируем пункты списка
             formatted_lines.append(line)
-        elif any(criterion in line for criterion in ['I (Independent)', 'N (Negotiable)',
-                                                   'V (Valuable)', 'E (Estimable)',
-                                                   'S (Small)', 'T (Testable)']):
-            # Форматируем критерии INVEST
+        else:
+            # Критерии INVEST меняются только при наличии отметки - дешевая проверка
+            # подстроки идет раньше регулярного выражения
             if '✓' in line:
-                line = line.replace('✓', '✅')
+                if _INVEST_CRITERIA_RE.search(line):
+                    line = line.replace('✓', '✅')
             elif '✗' in line:
-                line = line.replace('✗', '❌')
+                if _INVEST_CRITERIA_RE.search(line):
+                    line = line.replace('✗', '❌')
             formatted_lines.append(line)
-        else:
-            formatted_lines.append(line)
-
-    result = '\n'.join(formatted_lines)
 
-    # Добавляем User Story только если предоставлена и не пустая
-    if user_story and user_story.strip():
-        result = f"**User Story:**\n_{user_story}_\n\n{result}"
+        total_len += len(formatted_lines[-1]) + 1
 
-    return safe_truncate_text(result)
+    return safe_truncate_text(header + '\n'.join(formatted_lines), _DISPLAY_LIMIT)
 
-def should_show_add_to_db_button(analysis_text: str, is_improved: bool = False) -> bool:
+def should_show_add_to_db_button(analysis_text: str, is_improved: bool = False,
+                                 score: Optional[int] = None) -> bool:
     """
     Определяет, нужно ли показывать кнопку 'Добавить в базу'.
+    Если оценка уже извлечена вызывающим кодом, ее можно передать в score.
     """
     if not analysis_text:
         return False
 
-    score = extract_score_from_analysis(analysis_text)
+    if score is None:
+        score = extract_score_from_analysis(analysis_text)
 
     # Для улучшенных историй - более строгий порог
     if is_improved: